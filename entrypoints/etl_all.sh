@@ -0,0 +1,3 @@
+#!/bin/bash
+
+python3 etl/app.py --all
\ No newline at end of file
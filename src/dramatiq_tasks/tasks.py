@@ -1,5 +1,9 @@
+import inspect
 import logging
+import threading
+from contextlib import contextmanager
 from logging import handlers
+from typing import List, Optional
 
 import dramatiq
 from dramatiq.brokers.redis import RedisBroker
@@ -26,6 +30,7 @@ thehive_connector = TheHiveConnector(
     l2_api_key=config.thehive_l2_apikey,
     lpagetest_api_key=config.lpagetest_api_key,
     cert=config.thehive_check_cert,
+    create_concurrency=config.thehive_create_concurrency,
     logger=logger
 )
 qradar_connector = QRadarConnector(
@@ -33,18 +38,83 @@ qradar_connector = QRadarConnector(
     api_token=config.qradar_api_token,
     server_ip=config.qradar_server_ip,
     verify_ssl=config.qradar_verify_ssl,
+    pool_connections=config.qradar_pool_connections,
+    pool_maxsize=config.qradar_pool_maxsize,
+    connect_timeout=config.qradar_connect_timeout,
+    read_timeout=config.qradar_read_timeout,
+    aql_check_period=config.qradar_aql_max_check_period,
+    aql_min_check_period=config.qradar_aql_min_check_period,
+    aql_max_concurrent_searches=config.qradar_aql_max_concurrent_searches,
     logger=logger
 )
 
+
+# версия dramatiq, RedisBroker которой вызывает scripts['dispatch'] так, как ожидает PipelinedDispatch
+PIPELINED_DISPATCH_DRAMATIQ_VERSION = '1.11.0'
+
+
+class PipelinedDispatch:
+    """
+    Обёртка над lua-скриптом dispatch брокера: пока в потоке открыт pipelined_enqueue,
+    скрипт выполняется в pipeline этого потока, иначе - как обычно
+    """
+
+    def __init__(self, script):
+        # обёртка опирается на внутренности RedisBroker, после обновления dramatiq их нужно перепроверить
+        if dramatiq.__version__ != PIPELINED_DISPATCH_DRAMATIQ_VERSION:
+            raise RuntimeError(f'PipelinedDispatch supports dramatiq {PIPELINED_DISPATCH_DRAMATIQ_VERSION}, '
+                               f'found {dramatiq.__version__}')
+        if not {'keys', 'args', 'client'} <= set(inspect.signature(script).parameters):
+            raise RuntimeError(f'unexpected dispatch script signature {inspect.signature(script)}')
+        self.script = script
+        self.local = threading.local()
+
+    def __call__(self, keys: Optional[list] = None, args: Optional[list] = None, client=None):
+        return self.script(keys=keys or [], args=args or [],
+                           client=client or getattr(self.local, 'pipeline', None))
+
+
 redis_broker = RedisBroker(host=config.redis_host)
+redis_broker.scripts['dispatch'] = PipelinedDispatch(redis_broker.scripts['dispatch'])
 dramatiq.set_broker(redis_broker)
 
 
+@contextmanager
+def pipelined_enqueue():
+    """
+    Все сообщения, отправленные в контексте из текущего потока, ставятся в очередь
+    одной транзакцией Redis при выходе из него, в порядке отправки.
+    Если внутри контекста возникла ошибка, не ставится ни одно сообщение.
+    """
+    dispatch = redis_broker.scripts['dispatch']
+    pipeline = redis_broker.client.pipeline(transaction=True)
+    dispatch.local.pipeline = pipeline
+    try:
+        yield
+    finally:
+        dispatch.local.pipeline = None
+    pipeline.execute()
+
+
 @dramatiq.actor(max_backoff=MAX_BACKOFF, max_age=MAX_AGE)
 def create_alert(alert_data: dict, organisation: str):
     thehive_connector.create_alert(alert_data, organisation)
 
 
+@dramatiq.actor(max_backoff=MAX_BACKOFF, max_age=MAX_AGE)
+def create_alerts(alerts_data: List[dict], organisation: str):
+    """Создаёт пачку алертов, каждый алерт с ошибкой повторяется отдельным сообщением create_alert"""
+    errors = thehive_connector.create_alerts(alerts_data, organisation)
+    for alert_data, error in zip(alerts_data, errors):
+        if not error:
+            continue
+        logger.warning('alert %s failed, retrying separately - %s', alert_data.get('sourceRef'), error)
+        create_alert.send(
+            alert_data=alert_data,
+            organisation=organisation
+        )
+
+
 @dramatiq.actor(max_backoff=MAX_BACKOFF, max_age=MAX_AGE)
 def edit_offense(**kwargs):
     qradar_connector.edit_offense(**kwargs)
@@ -5,38 +5,79 @@ p = os.path.abspath('.')
 sys.path.insert(1, p)
 
 import argparse
-import time
+from typing import List
 
 from dependency_injector.wiring import inject
 
 from etl.containers import Container
 from etl.logger import get_logger
-from etl.filters import utils
+from etl import metrics, periodic
+from etl.filters import utils, filter_funcs
 from etl.workers import etl_elk, etl_sh_dm_qradar, etl_sh_vcm_001_qradar, etl_qradar
 from settings import config
 
 logger = get_logger()
 
+PIPELINES = {
+    'elk': etl_elk.run,
+    'qradar': etl_qradar.run,
+    'sh_dm_qradar': etl_sh_dm_qradar.run,
+    'sh_vcm_001_qradar': etl_sh_vcm_001_qradar.run,
+}
+
+
+def get_pipeline_names(args: argparse.Namespace) -> List[str]:
+    if args.all:
+        return list(PIPELINES)
+    if args.pipelines:
+        return [name.strip() for name in args.pipelines.split(',') if name.strip()]
+    return [name for name in PIPELINES if getattr(args, name)]
+
 
 @inject
 def main(args: argparse.Namespace):
-    etl_func = None
-    if args.elk:
-        etl_func = etl_elk.run
-    elif args.sh_dm_qradar:
-        etl_func = etl_sh_dm_qradar.run
-    elif args.sh_vcm_001_qradar:
-        etl_func = etl_sh_vcm_001_qradar.run
-    elif args.qradar:
-        etl_func = etl_qradar.run
-    else:
-        logger.error('wrong argument')
+    pipeline_names = get_pipeline_names(args)
+    unknown_names = [name for name in pipeline_names if name not in PIPELINES]
+    if not pipeline_names or unknown_names:
+        logger.error('wrong argument %s', unknown_names)
         quit()
 
-    logger.info('etl started')
-    while True:
-        etl_func()
-        time.sleep(config.etl_sleep_time)
+    if config.ninox_snapshot_enabled:
+        periodic.run_periodically(
+            lambda: utils.refresh_ninox_snapshot(filter_funcs.ninox_connector),
+            config.ninox_snapshot_refresh_period,
+            'ninox_snapshot'
+        )
+
+    if config.portals_uc_prefetch_enabled:
+        periodic.run_periodically(
+            lambda: utils.warm_use_case_cache(filter_funcs.portals_connector),
+            config.portals_uc_prefetch_period,
+            'uc_prefetch'
+        )
+
+    if config.metrics_enabled:
+        metrics.start_http_server(config.metrics_port)
+        periodic.run_periodically(metrics.log_summary, config.metrics_log_period, 'metrics_summary')
+
+    logger.info('etl started: %s', ', '.join(pipeline_names))
+
+    # несколько пайплайнов в одном процессе делят соединения, сессии и кэши, у каждого свой поток и таймер
+    threads = [
+        periodic.run_adaptively(
+            PIPELINES[name],
+            periodic.AdaptiveSchedule(
+                base_period=config.etl_pipeline_sleep_time.get(name, config.etl_sleep_time),
+                max_period=config.etl_max_sleep_time,
+                factor=config.etl_sleep_backoff_factor,
+                jitter=config.etl_sleep_jitter
+            ),
+            f'etl_{name}'
+        )
+        for name in pipeline_names
+    ]
+    for thread in threads:
+        thread.join()
 
 
 if __name__ == '__main__':
@@ -45,6 +86,8 @@ if __name__ == '__main__':
     parser.add_argument("--sh_dm_qradar", help="start SH-DM alert ETL from QRadar")
     parser.add_argument("--sh_vcm_001_qradar", help="start SH-VCM-001 alert ETL from QRadar")
     parser.add_argument("--qradar", help="start alert ETL from QRadar")
+    parser.add_argument("--pipelines", help=f"start comma-separated alert ETLs in one process: {', '.join(PIPELINES)}")
+    parser.add_argument("--all", action="store_true", help="start all alert ETLs in one process")
     args = parser.parse_args()
 
     container = Container()
@@ -52,6 +95,7 @@ if __name__ == '__main__':
     container.wire(
         modules=[
             sys.modules[__name__],
+            metrics,
             utils,
             etl_elk,
             etl_sh_dm_qradar,
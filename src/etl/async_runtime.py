@@ -0,0 +1,158 @@
+import asyncio
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from etl.logger import get_logger
+from objects.etl_data import ETLData
+from objects.state import State
+
+logger = get_logger()
+
+# маркер окончания входной очереди стадии
+_DONE = object()
+
+
+async def _produce(loop: asyncio.AbstractEventLoop,
+                   executor: ThreadPoolExecutor,
+                   producer_func: Callable,
+                   state_value,
+                   output: asyncio.Queue,
+                   consumers: int) -> int:
+    """Читает пачки источника в потоке и нумерует их по порядку чтения
+
+    При отмене генератор источника закрывается, чтобы он освободил свои ресурсы (например, PIT в ELK)
+    """
+
+    batches = iter(producer_func(state_value))
+    reading = None
+    seq = 0
+    try:
+        while True:
+            reading = executor.submit(next, batches, None)
+            data = await asyncio.wrap_future(reading)
+            if data is None:
+                break
+            if not data:
+                continue
+            await output.put((seq, data))
+            seq += 1
+    finally:
+        await loop.run_in_executor(executor, _close_producer, batches, reading)
+
+    for _ in range(consumers):
+        await output.put(_DONE)
+    return seq
+
+
+def _close_producer(batches, reading: Optional[futures.Future]):
+    """Закрывает генератор источника, дождавшись незавершённого чтения пачки: его нельзя закрыть во время next"""
+
+    if reading is not None:
+        futures.wait([reading])
+    close = getattr(batches, 'close', None)
+    if close is not None:
+        close()
+
+
+async def _run_stage(loop: asyncio.AbstractEventLoop,
+                     executor: ThreadPoolExecutor,
+                     filter_func: Callable,
+                     concurrency: int,
+                     input_: asyncio.Queue,
+                     output: asyncio.Queue,
+                     done: asyncio.Queue,
+                     consumers: int):
+    """Обрабатывает пачки стадии в concurrency потоках, пустой результат сразу уходит на фиксацию"""
+
+    async def worker():
+        while (item := await input_.get()) is not _DONE:
+            seq, data = item
+            data = await loop.run_in_executor(executor, filter_func, data)
+            if data:
+                await output.put((seq, data))
+            else:
+                await done.put((seq, data))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    for _ in range(consumers):
+        await output.put(_DONE)
+
+
+async def _commit(loop: asyncio.AbstractEventLoop,
+                  executor: ThreadPoolExecutor,
+                  state: State,
+                  state_key: str,
+                  update_state_value_func: Callable,
+                  done: asyncio.Queue):
+    """Сохраняет состояние строго в порядке чтения пачек: пачка фиксируется, когда обработаны все предыдущие"""
+
+    finished: Dict[int, Optional[ETLData]] = {}
+    next_seq = 0
+    while (item := await done.get()) is not _DONE:
+        seq, data = item
+        finished[seq] = data
+        while next_seq in finished:
+            data = finished.pop(next_seq)
+            if data:
+                await loop.run_in_executor(executor, state.set_state, state_key, update_state_value_func(data))
+            next_seq += 1
+
+
+async def _run(stages: List[Callable],
+               concurrency: List[int],
+               queue_size: int,
+               state: State,
+               state_key: str,
+               update_state_value_func: Callable,
+               producer_func: Callable):
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=sum(concurrency) + 2, thread_name_prefix='etl-stage') as executor:
+        state_value = await loop.run_in_executor(executor, state.get_state, state_key)
+
+        queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+        done = asyncio.Queue()
+        tasks = [
+            asyncio.ensure_future(_produce(loop, executor, producer_func, state_value, queues[0], concurrency[0]))
+        ]
+        for index, filter_func in enumerate(stages):
+            is_last = index == len(stages) - 1
+            tasks.append(asyncio.ensure_future(_run_stage(
+                loop,
+                executor,
+                filter_func,
+                concurrency[index],
+                queues[index],
+                done if is_last else queues[index + 1],
+                done,
+                1 if is_last else concurrency[index + 1]
+            )))
+        tasks.append(asyncio.ensure_future(
+            _commit(loop, executor, state, state_key, update_state_value_func, done)
+        ))
+
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            # отменённые задачи завершаются (источник закрывается) до остановки пула потоков
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+
+def run_pipeline(stages: List[Callable],
+                 concurrency: List[int],
+                 queue_size: int,
+                 state: State,
+                 state_key: str,
+                 update_state_value_func: Callable,
+                 producer_func: Callable):
+    """Выполняет стадии пайплайна одновременно для разных пачек
+
+    Стадии связаны ограниченными очередями queue_size, каждая стадия обрабатывает до concurrency[i] пачек
+    одновременно в пуле потоков. Состояние источника сохраняется в порядке чтения пачек, поэтому после
+    ошибки пайплайн перечитает все пачки, начиная с первой необработанной
+    """
+
+    asyncio.run(_run(stages, concurrency, queue_size, state, state_key, update_state_value_func, producer_func))
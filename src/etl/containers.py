@@ -1,22 +1,52 @@
 from dependency_injector import containers, providers
 
 from objects.RedisStorage import RedisStorage
+from objects.ninox_snapshot import NinoxSnapshot
+from objects.redis_codec import make_codec
+from objects.source_ref_index import SourceRefIndex
 from objects.state import State
 from settings import config
 
 
 class Container(containers.DeclarativeContainer):
+    redis_codec = providers.Singleton(
+        make_codec,
+        config.redis_codec,
+        config.redis_compress_threshold
+    )
     redis_storage = providers.Singleton(
         RedisStorage,
-        config.redis_host
+        config.redis_host,
+        redis_codec
     )
 
     cache_state = providers.Singleton(
         State,
         redis_storage,
-        config.redis_info_ttl
+        config.redis_info_ttl,
+        config.state_max_local_entries,
+        config.redis_info_soft_ttl
     )
     etl_state = providers.Singleton(
         State,
-        redis_storage
+        redis_storage,
+        None,
+        config.state_max_local_entries
+    )
+    source_ref_index = providers.Singleton(
+        SourceRefIndex,
+        redis_storage,
+        config.redis_source_ref_index_key_prefix,
+        config.redis_source_ref_index_window,
+        config.redis_source_ref_index_warmup
+    )
+    ninox_snapshot = providers.Singleton(
+        NinoxSnapshot,
+        redis_storage,
+        config.redis_ninox_snapshot_key_prefix,
+        config.ninox_IS_table,
+        config.ninox_IS_UC_table,
+        config.ninox_IS_id_field,
+        config.ninox_modified_field,
+        config.ninox_snapshot_max_age
     )
@@ -1,7 +1,18 @@
+import time
 from functools import wraps
-from typing import Coroutine, Callable, Tuple
+from typing import Coroutine, Callable, List, NamedTuple, Optional
 
+from etl import async_runtime, metrics
 from objects.state import State
+from settings import config
+
+
+class CycleResult(NamedTuple):
+    """Итог одного прохода пайплайна: прочитанные пачки и алерты, полна ли (размером со страницу) последняя пачка"""
+
+    batches: int = 0
+    alerts: int = 0
+    last_batch_full: bool = False
 
 
 def coroutine(func):
@@ -14,20 +25,23 @@ def coroutine(func):
     return inner
 
 
-def producer_filter(target: Coroutine,
-                    state: State,
-                    state_key: str,
-                    update_state_value_func: Callable,
-                    filter_func: Callable):
-    """Описывает алгоритм первого фильтра"""
+def stream_producer_filter(target: Coroutine,
+                           state: State,
+                           state_key: str,
+                           update_state_value_func: Callable,
+                           filter_func: Callable):
+    """Описывает алгоритм первого фильтра, читающего источник пачками до конца
 
-    state_value = state.get_state(state_key)
+    filter_func возвращает итератор пачек ETLData, состояние сохраняется после обработки каждой пачки
+    """
 
-    data = filter_func(state_value)
+    state_value = state.get_state(state_key)
 
-    if data:
-        state_value = update_state_value_func(data)
+    for data in filter_func(state_value):
+        if not data:
+            continue
         target.send(data)
+        state_value = update_state_value_func(data)
         state.set_state(state_key, state_value)
 
 
@@ -48,4 +62,72 @@ def loader_filter(filter_func: Callable):
 
     while input_data := (yield):
         if input_data:
-            filter_func(input_data)
\ No newline at end of file
+            filter_func(input_data)
+
+
+def run_pipeline(stages: List[Callable],
+                 state: State,
+                 state_key: str,
+                 update_state_value_func: Callable,
+                 producer_func: Callable,
+                 batch_size: Optional[int] = None) -> CycleResult:
+    """Запускает пайплайн из producer_func и стадий stages в порядке прохождения данных
+
+    Каждая стадия - функция из ETLData в ETLData, последняя стадия - loader. Среда выполнения
+    выбирается настройкой etl_runtime: sync - цепочка генераторов, asyncio - стадии выполняются
+    одновременно для разных пачек с параллелизмом из etl_stage_concurrency.
+    Время и количество алертов каждой стадии учитываются в metrics под именем пайплайна state_key.
+    Если последняя пачка полная (размером batch_size), в источнике, скорее всего, уже есть следующие данные
+    """
+
+    counts = {'batches': 0, 'alerts': 0, 'last_batch_full': False}
+    source_func = producer_func
+
+    def counted_producer(state_value):
+        for data in source_func(state_value):
+            if data:
+                counts['batches'] += 1
+                counts['alerts'] += len(data)
+                counts['last_batch_full'] = bool(batch_size) and len(data) >= batch_size
+            yield data
+
+    stages = [metrics.timed_stage(state_key, stage) for stage in stages]
+    producer_func = metrics.timed_producer(state_key, wraps(source_func)(counted_producer))
+
+    started = time.monotonic()
+    try:
+        _run_pipeline(stages, state, state_key, update_state_value_func, producer_func)
+    except Exception:
+        metrics.registry.record_cycle(state_key, time.monotonic() - started, True)
+        raise
+    metrics.registry.record_cycle(state_key, time.monotonic() - started)
+    return CycleResult(**counts)
+
+
+def _run_pipeline(stages: List[Callable],
+                  state: State,
+                  state_key: str,
+                  update_state_value_func: Callable,
+                  producer_func: Callable):
+    if config.etl_runtime == 'asyncio':
+        async_runtime.run_pipeline(
+            stages=stages,
+            concurrency=[config.etl_stage_concurrency.get(stage.__name__, 1) for stage in stages],
+            queue_size=config.etl_queue_size,
+            state=state,
+            state_key=state_key,
+            update_state_value_func=update_state_value_func,
+            producer_func=producer_func
+        )
+        return
+
+    target = loader_filter(filter_func=stages[-1])
+    for filter_func in reversed(stages[:-1]):
+        target = filter_(target=target, filter_func=filter_func)
+    stream_producer_filter(
+        target=target,
+        state=state,
+        state_key=state_key,
+        update_state_value_func=update_state_value_func,
+        filter_func=producer_func
+    )
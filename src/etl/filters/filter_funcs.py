@@ -1,7 +1,5 @@
 import time
-
-from thehive4py.query import Or, Eq
-from typing import Optional
+from typing import Optional, List, Dict, Iterator, Union
 
 from dramatiq_tasks import tasks
 from etl.filters import utils, crafter
@@ -21,7 +19,10 @@ elk_connector = ELKConnector(
     url=config.elk_url,
     user=config.elk_user,
     password=config.elk_pass,
-    search_size=config.elk_search_size
+    search_size=config.elk_search_size,
+    pit_keep_alive=config.elk_pit_keep_alive,
+    source_fields=config.elk_source_fields.split(',') if config.elk_source_fields else None,
+    tiebreaker_field=config.elk_tiebreaker_field
 )
 
 thehive_connector = TheHiveConnector(
@@ -30,6 +31,8 @@ thehive_connector = TheHiveConnector(
     l2_api_key=config.thehive_l2_apikey,
     lpagetest_api_key=config.lpagetest_api_key,
     cert=config.thehive_check_cert,
+    search_chunk_size=config.thehive_search_chunk_size,
+    search_concurrency=config.thehive_search_concurrency,
     logger=get_logger()
 )
 
@@ -38,6 +41,13 @@ qradar_connector = QRadarConnector(
     api_token=config.qradar_api_token,
     server_ip=config.qradar_server_ip,
     verify_ssl=config.qradar_verify_ssl,
+    pool_connections=config.qradar_pool_connections,
+    pool_maxsize=config.qradar_pool_maxsize,
+    connect_timeout=config.qradar_connect_timeout,
+    read_timeout=config.qradar_read_timeout,
+    aql_check_period=config.qradar_aql_max_check_period,
+    aql_min_check_period=config.qradar_aql_min_check_period,
+    aql_max_concurrent_searches=config.qradar_aql_max_concurrent_searches,
     logger=get_logger()
 )
 
@@ -46,7 +56,9 @@ portals_connector = PortalsConnector(
     username=config.portals_user,
     password=config.portals_pass,
     obtain_tokens_url=config.portals_obtain_token_url,
-    refresh_token_url=config.portals_refresh_token_url
+    refresh_token_url=config.portals_refresh_token_url,
+    pool_maxsize=config.portals_pool_maxsize,
+    token_refresh_leeway=config.portals_token_refresh_leeway
 )
 portals_connector.auth()
 
@@ -55,114 +67,139 @@ ninox_connector = NinoxConnector(
     username=config.ninox_username,
     password=config.ninox_password,
     team=config.ninox_team,
-    database=config.ninox_database
+    database=config.ninox_database,
+    scan_ttl=config.redis_negative_ttl.total_seconds()
 )
 ninox_connector.auth()
 
 
 # TODO Можно перенести get'еры прямо в логику producer filter, чтобы передавать в producer filter сразу методы
 # TODO elk_connector.search_docs и utils.craft_etl_data_from_elk (и для радара соответственно)
-def get_last_elk_alerts(last_time: Optional[str] = None) -> Optional[ETLData]:
-    elk_data = elk_connector.search_docs(
-        index=config.elk_index,
-        query=elk_connector.get_gte_timestamp_query(last_time)
-    )
-    if not elk_data:
-        return None
-
-    data = ETLData()
-    data.relevant = [
-        Alert(
-            source='ELK',
-            use_case=alert.get('_source', {}).get('case.id', ''),
-            information_system=alert.get('_source', {}).get('case.is.id', 'null'),
-            raw_data=alert,
-            source_ref=alert['_id']
-        ) for alert in elk_data
-    ]
-    return data
-
-
-def get_last_qradar_offenses(last_id: Optional[int] = None) -> Optional[ETLData]:
-    qradar_data = qradar_connector.get_offenses(
-        filter_=config.qradar_offense_filter.replace('{id}', str(last_id or 0)),
-        sort=config.qradar_search_sort,
-        fields=config.qradar_offense_fields,
-        range_=config.qradar_search_range
-    )
-    if not qradar_data:
-        return None
-
-    data = ETLData()
-    data.relevant = [
-        Alert(
-            source='QRadar',
-            raw_data=offense,
-            source_ref=str(offense['id'])
-        ) for offense in qradar_data
-    ]
-    return data
-
-
-def get_last_elk_alert_time(data: ETLData) -> str:
-    return data.relevant[-1].raw_data.get('_source', {}).get('timestamp')
-
-
-def get_last_sh_dm_qradar_offenses(last_id: Optional[int] = None) -> Optional[ETLData]:
-    sh_dm_data = qradar_connector.get_offenses(
-        filter_=config.qradar_sh_dm_offense_filter.replace('{id}', str(last_id or 0)),
-        sort=config.qradar_search_sort,
-        fields=config.qradar_sh_dm_offense_fields,
-        range_=config.qradar_search_range
-    )
-    if not sh_dm_data:
-        return None
-
-    data = ETLData()
-    data.relevant = [
-        Alert(
-            source='QRadar',
-            use_case=config.qradar_sh_dm_offense_type_map.get(offense['offense_type']),
-            raw_data=offense,
-            source_ref=str(offense['id'])
-        ) for offense in sh_dm_data
-    ]
-    return data
-
-
-def get_last_sh_vcm_001_qradar_offenses(last_id: Optional[int] = None) -> Optional[ETLData]:
-    sh_vcm_data = qradar_connector.get_offenses(
-        filter_=config.qradar_sh_vcm_001_offense_filter.replace('{id}', str(last_id or 0)),
-        sort=config.qradar_search_sort,
-        fields=config.qradar_sh_vcm_001_offense_fields,
-        range_=config.qradar_sh_vcm_001_search_range
-    )
-    if not sh_vcm_data:
-        return None
-
-    data = ETLData()
-    data.relevant = [
-        Alert(
-            source='QRadar',
-            use_case='SH-VCM-001',
-            information_system='INTERNAL',
-            raw_data=offense,
-            source_ref=str(offense['id'])
-        ) for offense in sh_vcm_data
-    ]
-    return data
+def get_last_elk_alerts(position: Union[dict, str, None] = None) -> Iterator[ETLData]:
+    # до перехода на search_after в состоянии хранилась только строка timestamp
+    if isinstance(position, str):
+        position = {'timestamp': position}
+    position = position or {}
+
+    for elk_data in elk_connector.iter_docs(
+            index=config.elk_index,
+            query=elk_connector.get_gte_timestamp_query(position.get('timestamp')),
+            search_after=position.get('sort')
+    ):
+        data = ETLData()
+        data.relevant = [
+            Alert(
+                source='ELK',
+                use_case=alert.get('_source', {}).get('case.id', ''),
+                information_system=alert.get('_source', {}).get('case.is.id', 'null'),
+                raw_data=alert,
+                source_ref=alert['_id']
+            ) for alert in elk_data
+        ]
+        yield data
+
+
+def get_range_size(range_: str) -> int:
+    """Размер страницы из заголовка Range вида items=0-49"""
+
+    start, stop = range_.split('=', 1)[1].split('-')
+    return int(stop) - int(start) + 1
+
+
+def iter_qradar_offense_pages(
+        filter_: str,
+        fields: str,
+        range_: str,
+        last_id: Optional[int] = None
+) -> Iterator[List[dict]]:
+    """Читает оффенсы страницами размера range_ с id > last_id, пока по Content-Range не прочитаны все"""
+
+    last_id = last_id or 0
+    while True:
+        offenses, total = qradar_connector.get_offenses_page(
+            filter_=filter_.replace('{id}', str(last_id)),
+            sort=config.qradar_search_sort,
+            fields=fields,
+            range_=range_
+        )
+        if not offenses:
+            return
+
+        yield offenses
+
+        if total is None or total <= len(offenses):
+            return
+        last_id = max(offense['id'] for offense in offenses)
+
+
+def get_last_qradar_offenses(last_id: Optional[int] = None) -> Iterator[ETLData]:
+    for qradar_data in iter_qradar_offense_pages(
+            filter_=config.qradar_offense_filter,
+            fields=config.qradar_offense_fields,
+            range_=config.qradar_search_range,
+            last_id=last_id
+    ):
+        data = ETLData()
+        data.relevant = [
+            Alert(
+                source='QRadar',
+                raw_data=offense,
+                source_ref=str(offense['id'])
+            ) for offense in qradar_data
+        ]
+        yield data
+
+
+def get_last_elk_alert_position(data: ETLData) -> dict:
+    last_alert = max(data.relevant + data.imported + data.irrelevant, key=lambda alert: alert.raw_data['sort'])
+    return {
+        'timestamp': last_alert.raw_data.get('_source', {}).get('timestamp'),
+        'id': last_alert.source_ref,
+        'sort': last_alert.raw_data['sort']
+    }
+
+
+def get_last_sh_dm_qradar_offenses(last_id: Optional[int] = None) -> Iterator[ETLData]:
+    for sh_dm_data in iter_qradar_offense_pages(
+            filter_=config.qradar_sh_dm_offense_filter,
+            fields=config.qradar_sh_dm_offense_fields,
+            range_=config.qradar_search_range,
+            last_id=last_id
+    ):
+        data = ETLData()
+        data.relevant = [
+            Alert(
+                source='QRadar',
+                use_case=config.qradar_sh_dm_offense_type_map.get(offense['offense_type']),
+                raw_data=offense,
+                source_ref=str(offense['id'])
+            ) for offense in sh_dm_data
+        ]
+        yield data
+
+
+def get_last_sh_vcm_001_qradar_offenses(last_id: Optional[int] = None) -> Iterator[ETLData]:
+    for sh_vcm_data in iter_qradar_offense_pages(
+            filter_=config.qradar_sh_vcm_001_offense_filter,
+            fields=config.qradar_sh_vcm_001_offense_fields,
+            range_=config.qradar_sh_vcm_001_search_range,
+            last_id=last_id
+    ):
+        data = ETLData()
+        data.relevant = [
+            Alert(
+                source='QRadar',
+                use_case='SH-VCM-001',
+                information_system='INTERNAL',
+                raw_data=offense,
+                source_ref=str(offense['id'])
+            ) for offense in sh_vcm_data
+        ]
+        yield data
 
 
 def get_last_qradar_offense_id(data: ETLData) -> int:
-    last_relevant_offense_id = 0
-    last_irrelevant_offense_id = 0
-    if data.relevant:
-        last_relevant_offense_id = data.relevant[-1].raw_data.get('id')
-    if data.irrelevant:
-        last_irrelevant_offense_id = data.irrelevant[-1].raw_data.get('id')
-    return last_relevant_offense_id \
-        if last_relevant_offense_id > last_irrelevant_offense_id \
-        else last_irrelevant_offense_id
+    return max(alert.raw_data.get('id') for alert in data.relevant + data.imported + data.irrelevant)
 
 
 def sh_vcm_001_qradar_filter(data: ETLData) -> ETLData:
@@ -247,21 +284,69 @@ def get_is_from_qradar(data: ETLData) -> ETLData:
 
 
 def get_is_from_sh_dm_qradar(data: ETLData) -> ETLData:
-    # TODO parallel this:
+    if not data.relevant:
+        return data
+
+    if config.qradar_sh_dm_domain_aql_batch:
+        domains = get_sh_dm_domains_by_batch(data.relevant)
+    else:
+        domains = get_sh_dm_domains_by_offense(data.relevant)
+
     for offense in data.relevant:
-        search_result = qradar_connector.aql_search(
-            query=config.qradar_sh_dm_domain_aql_query
-                .replace('{id}', str(offense.raw_data['id']))
-                .replace('{start_time}', str(offense.raw_data['start_time'] - 1))
-                .replace('{stop_time}', str(offense.raw_data['start_time'] + 1))
-        )
-        if 'events' in search_result and len(search_result['events']) != 0:
-            offense.information_system = search_result['events'][0].get('domain_name', config.qradar_default_domain)
-        else:
-            offense.information_system = config.qradar_default_domain
+        offense.information_system = domains.get(offense.raw_data['id']) or config.qradar_default_domain
     return data
 
 
+def get_sh_dm_domains_by_batch(offenses: List[Alert]) -> Dict[int, str]:
+    """Находит домены всех оффенсов одним AQL запросом по окну их start_time
+
+    CASE относит событие только к первому подходящему оффенсу, поэтому оффенсы, все события
+    которых достались другим оффенсам пачки, дозапрашиваются отдельными запросами
+    """
+
+    offense_ids = [offense.raw_data['id'] for offense in offenses]
+    start_time = min(offense.raw_data['start_time'] for offense in offenses) - 1
+    stop_time = max(offense.raw_data['start_time'] for offense in offenses) + 1
+
+    search_result = qradar_connector.aql_search(
+        query=config.qradar_sh_dm_domain_batch_aql_query
+            .replace('{offense_id}',
+                     'CASE %s ELSE 0 END' % ' '.join(f'WHEN INOFFENSE({id_}) THEN {id_}' for id_ in offense_ids))
+            .replace('{in_offenses}', ' OR '.join(f'INOFFENSE({id_})' for id_ in offense_ids))
+            .replace('{start_time}', str(start_time))
+            .replace('{stop_time}', str(stop_time))
+    )
+
+    domains = {}
+    if search_result and 'events' in search_result:
+        for event in search_result['events']:
+            if event.get('offense_id') is not None:
+                domains.setdefault(int(event['offense_id']), event.get('domain_name'))
+
+    missing_offenses = [offense for offense in offenses if offense.raw_data['id'] not in domains]
+    if missing_offenses:
+        domains.update(get_sh_dm_domains_by_offense(missing_offenses))
+    return domains
+
+
+def get_sh_dm_domains_by_offense(offenses: List[Alert]) -> Dict[int, str]:
+    """Находит домены оффенсов отдельным AQL запросом на каждый оффенс"""
+
+    queries = {
+        offense.raw_data['id']: config.qradar_sh_dm_domain_aql_query
+            .replace('{id}', str(offense.raw_data['id']))
+            .replace('{start_time}', str(offense.raw_data['start_time'] - 1))
+            .replace('{stop_time}', str(offense.raw_data['start_time'] + 1))
+        for offense in offenses
+    }
+
+    domains = {}
+    for offense_id, search_result in qradar_connector.aql_search_many(queries):
+        if search_result and 'events' in search_result and len(search_result['events']) != 0:
+            domains[offense_id] = search_result['events'][0].get('domain_name')
+    return domains
+
+
 def get_log_source_ip_from_qradar(data: ETLData) -> ETLData:
     if data.relevant:
         log_source_names = [offense.raw_data['offense_source'].replace('::', '@') for offense in data.relevant]
@@ -338,27 +423,25 @@ def uc_is_check(data: ETLData) -> ETLData:
 
 
 def check_alert_existing(data: ETLData) -> ETLData:
-    """Проверяет алерты на наличие в TheHive"""
+    """Проверяет алерты на наличие в TheHive
+
+    Алерты, уже известные локальному индексу sourceRef, в TheHive не запрашиваются
+    """
     if not data.relevant:
         return data
 
     alerts = data.relevant
     data.relevant = []
 
-    existing_alerts = thehive_connector.find_alerts(
-        query=Or(
-            *[Eq('sourceRef', alert.source_ref) for alert in alerts]
-        ),
-        organisation=TargetGroup.first_line.value
-    )
-    existing_alerts += thehive_connector.find_alerts(
-        query=Or(
-            *[Eq('sourceRef', alert.source_ref) for alert in alerts]
-        ),
-        organisation=TargetGroup.second_line.value
-    )
+    existing_alerts_source_refs, uncertain_source_refs = utils.split_source_refs(alerts)
+    if uncertain_source_refs:
+        found_source_refs = thehive_connector.find_existing_source_refs(
+            source_refs=uncertain_source_refs,
+            organisations=[TargetGroup.first_line.value, TargetGroup.second_line.value]
+        )
+        utils.remember_source_refs([alert for alert in alerts if alert.source_ref in found_source_refs])
+        existing_alerts_source_refs |= found_source_refs
 
-    existing_alerts_source_refs = {alert.get('sourceRef') for alert in existing_alerts}
     for alert in alerts:
         if alert.source_ref in existing_alerts_source_refs:
             data.imported.append(alert)
@@ -399,36 +482,47 @@ def craft_qradar_sh_vcm_001_alerts(data: ETLData) -> ETLData:
 def bulk_create_alerts(data: ETLData) -> ETLData:
     alerts = data.relevant
     data.relevant = []
+
+    alerts_by_organisation = {}
     for alert in alerts:
-        tasks.create_alert.send(
-            alert_data=alert.data,
-            organisation=alert.target_group.value
-        )
-        data.imported.append(alert)
+        alerts_by_organisation.setdefault(alert.target_group.value, []).append(alert)
+
+    batch_size = config.dramatiq_alert_batch_size
+    with tasks.pipelined_enqueue():
+        for organisation, organisation_alerts in alerts_by_organisation.items():
+            for i in range(0, len(organisation_alerts), batch_size):
+                tasks.create_alerts.send(
+                    alerts_data=[alert.data for alert in organisation_alerts[i:i + batch_size]],
+                    organisation=organisation
+                )
+    data.imported.extend(alerts)
+    utils.remember_source_refs(alerts)
 
     return data
 
 
 def bulk_follow_up_offenses(data: ETLData) -> ETLData:
-    for alert in data.imported:
-        tasks.edit_offense.send(
-            offense_id=alert.source_ref,
-            follow_up='true'
-        )
+    with tasks.pipelined_enqueue():
+        for alert in data.imported:
+            tasks.edit_offense.send(
+                offense_id=alert.source_ref,
+                follow_up='true'
+            )
 
     return data
 
 
 def bulk_close_offenses(data: ETLData) -> ETLData:
-    for alert in data.irrelevant:
-        tasks.edit_offense.send(
-            offense_id=alert.source_ref,
-            closing_reason_id=config.qradar_irp_integration_closing_reason,
-            status=config.qradar_closed_offense_status
-        )
-        tasks.add_note_to_offense.send(
-            offense_id=alert.source_ref,
-            note_text=alert.closing_reason
-        )
+    with tasks.pipelined_enqueue():
+        for alert in data.irrelevant:
+            tasks.edit_offense.send(
+                offense_id=alert.source_ref,
+                closing_reason_id=config.qradar_irp_integration_closing_reason,
+                status=config.qradar_closed_offense_status
+            )
+            tasks.add_note_to_offense.send(
+                offense_id=alert.source_ref,
+                note_text=alert.closing_reason
+            )
 
     return data
@@ -1,13 +1,27 @@
-from typing import List, Optional, Callable
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Callable, Set, Tuple
 
 from dependency_injector.wiring import inject, Provide
 
 from etl.containers import Container
-from objects.NinoxConnector import NinoxConnector
+from etl.logger import get_logger
+from objects.NinoxConnector import NinoxConnector, NinoxSchemaError
+from objects.PortalsConnector import PortalsConnector
 from objects.etl_data import Alert, ETLData, TargetGroup, Status
-from objects.state import State
+from objects.ninox_snapshot import NinoxSnapshot
+from objects.source_ref_index import SourceRefIndex
+from objects.state import State, NEGATIVE_VALUE
 from settings import config
 
+logger = get_logger()
+
+# фоновое обновление устаревших значений кэша, ключи в процессе обновления не ставятся повторно
+_refresh_executor = ThreadPoolExecutor(max_workers=config.cache_refresh_workers, thread_name_prefix='cache-refresh')
+_refreshing_keys = set()
+_refreshing_lock = threading.Lock()
+
 
 def enrich_alerts_by_is(alerts: List[Alert], information_systems: dict):
     for alert in alerts:
@@ -84,6 +98,148 @@ def filter_alerts(data: ETLData):
             data.irrelevant.append(alert)
 
 
+def _store_fetched_values(keys: List, cache_key_prefix: str, fetched_values: dict, cache: State) -> dict:
+    """Кэширует найденные значения, ненайденные ключи - маркером NEGATIVE_VALUE на срок redis_negative_ttl"""
+
+    found_values = {key: fetched_values[key] for key in keys if fetched_values.get(key)}
+    cache.set_states({f'{cache_key_prefix}{key}': value for key, value in found_values.items()})
+    cache.set_states(
+        {f'{cache_key_prefix}{key}': NEGATIVE_VALUE for key in keys if key not in found_values},
+        config.redis_negative_ttl
+    )
+    return found_values
+
+
+def _lock_keys(keys: List, cache_key_prefix: str) -> dict:
+    return {f'{config.redis_lock_key_prefix}{cache_key_prefix}{key}': key for key in keys}
+
+
+def _split_refilled_keys(keys: List, cache_key_prefix: str, cache: State) -> Tuple[dict, List]:
+    """Перечитывает ключи из Redis мимо памяти процесса после взятия блокировки
+
+    Возвращает значения ключей, которые другой процесс уже обновил (свежие, не старше soft_ttl),
+    и ключи, которые по-прежнему нужно запросить из источника
+    """
+
+    stored_values = cache.get_stored_states_with_ttl([f'{cache_key_prefix}{key}' for key in keys])
+    values = {}
+    keys_to_fetch = []
+    for key in keys:
+        value, ttl_left = stored_values[f'{cache_key_prefix}{key}']
+        if value and not cache.is_stale(ttl_left):
+            values[key] = None if value == NEGATIVE_VALUE else value
+        else:
+            keys_to_fetch.append(key)
+    return values, keys_to_fetch
+
+
+def _refresh_cached_values(keys: List, cache_key_prefix: str, fetch_func: Callable[[List], dict], cache: State):
+    # ключи, заблокированные другим процессом, уже обновляются им, уже обновлённые - пропускаются
+    lock_keys = _lock_keys(keys, cache_key_prefix)
+    tokens = {}
+    try:
+        tokens = cache.storage.acquire_locks(list(lock_keys), config.redis_lock_ttl)
+        _, owned_keys = _split_refilled_keys([lock_keys[lock_key] for lock_key in tokens], cache_key_prefix, cache)
+        if owned_keys:
+            _store_fetched_values(owned_keys, cache_key_prefix, fetch_func(owned_keys), cache)
+    except Exception:
+        logger.exception('background refresh of %s%s failed', cache_key_prefix, keys)
+    finally:
+        cache.storage.release_locks(tokens)
+        with _refreshing_lock:
+            _refreshing_keys.difference_update((cache_key_prefix, key) for key in keys)
+
+
+def _schedule_refresh(keys: List, cache_key_prefix: str, fetch_func: Callable[[List], dict], cache: State):
+    with _refreshing_lock:
+        keys = [key for key in keys if (cache_key_prefix, key) not in _refreshing_keys]
+        _refreshing_keys.update((cache_key_prefix, key) for key in keys)
+    if keys:
+        _refresh_executor.submit(_refresh_cached_values, keys, cache_key_prefix, fetch_func, cache)
+
+
+def _fetch_single_flight(keys: List, cache_key_prefix: str, fetch_func: Callable[[List], dict], cache: State) -> dict:
+    """Получает ключи из источника так, чтобы каждый ключ запрашивал только один процесс
+
+    Процесс берёт блокировки ключей в Redis и запрашивает только свои ключи, которых после взятия
+    блокировки всё ещё нет в Redis. Ключи, заблокированные другим процессом, ожидаются в кэше
+    до cache_lock_wait, после чего процесс запрашивает их сам
+    """
+
+    lock_keys = _lock_keys(keys, cache_key_prefix)
+    tokens = cache.storage.acquire_locks(list(lock_keys), config.redis_lock_ttl)
+    values = {}
+    try:
+        values, owned_keys = _split_refilled_keys(
+            [lock_keys[lock_key] for lock_key in tokens], cache_key_prefix, cache
+        )
+        if owned_keys:
+            values.update(_store_fetched_values(owned_keys, cache_key_prefix, fetch_func(owned_keys), cache))
+    finally:
+        cache.storage.release_locks(tokens)
+
+    waiting_keys = [lock_keys[lock_key] for lock_key in lock_keys if lock_key not in tokens]
+    deadline = time.monotonic() + config.cache_lock_wait.total_seconds()
+    while waiting_keys and time.monotonic() < deadline:
+        time.sleep(config.cache_lock_poll_interval)
+        cached_values = cache.get_states([f'{cache_key_prefix}{key}' for key in waiting_keys])
+        still_waiting_keys = []
+        for key in waiting_keys:
+            value = cached_values[f'{cache_key_prefix}{key}']
+            if value == NEGATIVE_VALUE:
+                continue
+            elif value:
+                values[key] = value
+            else:
+                still_waiting_keys.append(key)
+        waiting_keys = still_waiting_keys
+
+    if waiting_keys:
+        logger.warning('%s%s were not fetched by lock owner in time, fetching', cache_key_prefix, waiting_keys)
+        values.update(_store_fetched_values(waiting_keys, cache_key_prefix, fetch_func(waiting_keys), cache))
+
+    return values
+
+
+def _resolve_cached_values(
+        keys: List,
+        cache_key_prefix: str,
+        fetch_func: Callable[[List], dict],
+        cache: State
+) -> dict:
+    """Берёт значения ключей из кэша одним запросом, недостающие получает fetch_func и кэширует одним запросом
+
+    Ключи, которых нет в источнике, кэшируются маркером NEGATIVE_VALUE на меньший срок redis_negative_ttl.
+    Устаревшие (старше soft_ttl) значения отдаются как есть и обновляются в фоне.
+    Каждый отсутствующий в кэше ключ запрашивается из источника одним процессом (_fetch_single_flight)
+    """
+
+    cached_values = cache.get_states_with_ttl([f'{cache_key_prefix}{key}' for key in keys])
+    values = {}
+    missing_keys = []
+    stale_keys = []
+    for key in keys:
+        value, ttl_left = cached_values[f'{cache_key_prefix}{key}']
+        if value == NEGATIVE_VALUE:
+            cache.negative_hits[cache_key_prefix] += 1
+            values[key] = None
+        elif value:
+            values[key] = value
+            if cache.is_stale(ttl_left):
+                stale_keys.append(key)
+        else:
+            missing_keys.append(key)
+
+    if stale_keys:
+        _schedule_refresh(stale_keys, cache_key_prefix, fetch_func, cache)
+
+    if missing_keys:
+        values.update(dict.fromkeys(missing_keys))
+        values.update(_fetch_single_flight(missing_keys, cache_key_prefix, fetch_func, cache))
+
+    return values
+
+
 @inject
 def get_cached_values(
         keys_dict: dict,
@@ -93,39 +249,153 @@ def get_cached_values(
         cache: State = Provide[Container.cache_state],
 
 ) -> dict:
-    for key in keys_dict:
-        value = cache.get_state(f'{cache_key_prefix}{key}')
-        if not value:
-            value = get_func(key, **get_func_kwargs) if get_func_kwargs else get_func(key)
-            cache.set_state(f'{cache_key_prefix}{key}', value)
-        keys_dict[key] = value
+    def fetch(keys: List) -> dict:
+        return {key: get_func(key, **get_func_kwargs) if get_func_kwargs else get_func(key) for key in keys}
+
+    keys_dict.update(_resolve_cached_values(list(keys_dict), cache_key_prefix, fetch, cache))
     return keys_dict
 
 
+def fetch_information_systems(keys: List[str], ninox_connector: NinoxConnector) -> dict:
+    """Загружает ИС из Ninox вместе со связанными строками IS-UC"""
+
+    information_systems = None
+    if config.ninox_IS_exact_lookup_enabled:
+        try:
+            # один просмотр таблицы отвечает на все ключи пачки
+            information_systems = \
+                ninox_connector.find_many_by_field(config.ninox_IS_table, config.ninox_IS_id_field, keys)
+        except NinoxSchemaError as e:
+            # поле id ИС не найдено в таблице - полнотекстовый поиск, как до поиска по полю
+            logger.warning('%s, falling back to full-text search', e)
+
+    if information_systems is None:
+        information_systems = {}
+        for key in keys:
+            information_system_info = ninox_connector.find_by_string(config.ninox_IS_table, key)
+            if information_system_info:
+                information_systems[key] = information_system_info[0]
+
+    # связанные строки IS-UC всех ИС загружаются одним запросом к таблице
+    is_uc_rows = ninox_connector.get_by_row_ids(
+        config.ninox_IS_UC_table,
+        [
+            row_id
+            for information_system_info in information_systems.values()
+            for row_id in information_system_info.get(config.ninox_IS_UC_table) or []
+        ]
+    )
+
+    for information_system_info in information_systems.values():
+        is_uc_mapping = information_system_info.get(config.ninox_IS_UC_table)
+        if is_uc_mapping:
+            information_system_info[config.ninox_IS_UC_table] = \
+                [is_uc_rows[str(row_id)] for row_id in is_uc_mapping if str(row_id) in is_uc_rows]
+
+    return information_systems
+
+
 @inject
 def get_all_information_systems(
         alerts: List[Alert],
         ninox_connector: NinoxConnector,
         is_cache: State = Provide[Container.cache_state],
+        ninox_snapshot: NinoxSnapshot = Provide[Container.ninox_snapshot],
 ) -> dict:
-    information_systems = dict.fromkeys([alert.information_system for alert in alerts if alert.information_system])
-    for key in information_systems:
-        information_system_info = is_cache.get_state(f'{config.redis_IS_key_prefix}{key}')
-        if not information_system_info:
-            information_system_info = ninox_connector.find_by_string(config.ninox_IS_table, key)
-            if not information_system_info:
-                continue
-            information_system_info = information_system_info[0]
+    keys = list(dict.fromkeys([alert.information_system for alert in alerts if alert.information_system]))
 
-            is_uc_mapping = information_system_info.get(config.ninox_IS_UC_table)
-            if is_uc_mapping:
-                information_system_info[config.ninox_IS_UC_table] = \
-                    [ninox_connector.get_by_row_id(config.ninox_IS_UC_table, row_id) for row_id in is_uc_mapping]
-                information_system_info[config.ninox_IS_UC_table] = \
-                    [x for x in information_system_info[config.ninox_IS_UC_table] if x]
+    if config.ninox_snapshot_enabled:
+        snapshot_information_systems = ninox_snapshot.get_information_systems(keys)
+        if snapshot_information_systems is not None:
+            return snapshot_information_systems
 
-            is_cache.set_state(f'{config.redis_IS_key_prefix}{key}', information_system_info)
+    return _resolve_cached_values(
+        keys,
+        config.redis_IS_key_prefix,
+        lambda missing_keys: fetch_information_systems(missing_keys, ninox_connector),
+        is_cache
+    )
 
-        information_systems[key] = information_system_info
 
-    return information_systems
+@inject
+def split_source_refs(
+        alerts: List[Alert],
+        source_ref_index: SourceRefIndex = Provide[Container.source_ref_index]
+) -> Tuple[Set[str], Set[str]]:
+    """Разделяет sourceRef алертов на уже известные и требующие проверки в TheHive"""
+
+    known_source_refs, uncertain_source_refs = set(), set()
+    for source in {alert.source for alert in alerts}:
+        known, uncertain = source_ref_index.split(
+            source,
+            [alert.source_ref for alert in alerts if alert.source == source]
+        )
+        known_source_refs |= known
+        uncertain_source_refs |= uncertain
+    return known_source_refs, uncertain_source_refs
+
+
+@inject
+def remember_source_refs(
+        alerts: List[Alert],
+        source_ref_index: SourceRefIndex = Provide[Container.source_ref_index]
+):
+    for source in {alert.source for alert in alerts}:
+        source_ref_index.add(source, [alert.source_ref for alert in alerts if alert.source == source])
+
+
+@inject
+def refresh_ninox_snapshot(
+        ninox_connector: NinoxConnector,
+        ninox_snapshot: NinoxSnapshot = Provide[Container.ninox_snapshot]
+):
+    updated = ninox_snapshot.refresh(ninox_connector)
+    logger.info('ninox snapshot refreshed, %s information systems updated', updated)
+
+
+def _has_detail_shape(listed_use_case: dict, detailed_use_case: dict) -> bool:
+    """Элемент списка сценариев содержит те же поля тех же типов, что и ответ get_uc_info"""
+
+    return all(
+        key in listed_use_case and type(listed_use_case[key]) is type(value)
+        for key, value in detailed_use_case.items()
+    )
+
+
+@inject
+def warm_use_case_cache(
+        portals_connector: PortalsConnector,
+        uc_cache: State = Provide[Container.cache_state]
+):
+    """Загружает в кэш UC: все сценарии Use-Case Portal одним проходом по списку
+
+    Ключи кэша - значения поля portals_uc_id_field, по которым сценарий находит get_uc_info. Поле проверяется
+    запросом первого сценария списка; если элементы списка не совпадают по виду с ответом get_uc_info,
+    кэш не загружается и сценарии запрашиваются по одному по мере появления в алертах
+    """
+
+    use_cases = {
+        str(use_case[config.portals_uc_id_field]): use_case
+        for use_case in portals_connector.get_all_uc_info()
+        if use_case.get(config.portals_uc_id_field)
+    }
+    if not use_cases:
+        logger.warning('no use cases with field %s in listing, cache is not warmed', config.portals_uc_id_field)
+        return
+
+    sample_id = next(iter(use_cases))
+    sample = portals_connector.get_uc_info(sample_id)
+    if not sample:
+        logger.warning('use case %s from listing field %s is not found by id, cache is not warmed',
+                       sample_id, config.portals_uc_id_field)
+        return
+
+    if not _has_detail_shape(use_cases[sample_id], sample):
+        logger.warning('use case listing differs from use case details, cache is not warmed')
+        return
+
+    uc_cache.set_states({
+        f'{config.redis_use_case_key_prefix}{use_case_id}': use_case
+        for use_case_id, use_case in use_cases.items()
+    })
+    logger.info('use case cache warmed, %s use cases', len(use_cases))
@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator
+
+from dependency_injector.wiring import inject, Provide
+
+from etl.containers import Container
+from etl.logger import get_logger
+from objects.etl_data import ETLData
+from objects.state import State
+
+logger = get_logger()
+
+GROUPS = ('relevant', 'imported', 'irrelevant')
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.alerts_in = 0
+        self.alerts_out = dict.fromkeys(GROUPS, 0)
+
+
+class CycleStats:
+    def __init__(self):
+        self.cycles = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.last_seconds = 0.0
+
+
+class Metrics:
+    """Счётчики времени и количества алертов по стадиям пайплайнов, доступ потокобезопасен"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = defaultdict(StageStats)
+        self.cycles = defaultdict(CycleStats)
+
+    def record_stage(self, pipeline: str, stage: str, seconds: float, alerts_in: int, data, failed: bool = False):
+        with self.lock:
+            stats = self.stages[pipeline, stage]
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.alerts_in += alerts_in
+            if failed:
+                stats.errors += 1
+            elif isinstance(data, ETLData):
+                for group in GROUPS:
+                    stats.alerts_out[group] += len(getattr(data, group))
+
+    def record_cycle(self, pipeline: str, seconds: float, failed: bool = False):
+        with self.lock:
+            stats = self.cycles[pipeline]
+            stats.cycles += 1
+            stats.seconds += seconds
+            stats.last_seconds = seconds
+            if failed:
+                stats.errors += 1
+
+
+registry = Metrics()
+
+
+def timed_stage(pipeline: str, filter_func: Callable) -> Callable:
+    """Оборачивает стадию: время выполнения, алерты на входе и выходе по группам, ошибки"""
+
+    @wraps(filter_func)
+    def inner(data: ETLData) -> ETLData:
+        alerts_in = len(data) if data else 0
+        started = time.monotonic()
+        try:
+            result = filter_func(data)
+        except Exception:
+            registry.record_stage(pipeline, filter_func.__name__, time.monotonic() - started, alerts_in, None, True)
+            raise
+        registry.record_stage(pipeline, filter_func.__name__, time.monotonic() - started, alerts_in, result)
+        return result
+
+    return inner
+
+
+def timed_producer(pipeline: str, producer_func: Callable) -> Callable:
+    """Оборачивает генератор пачек источника: время чтения каждой пачки и прочитанные алерты"""
+
+    @wraps(producer_func)
+    def inner(state_value) -> Iterator[ETLData]:
+        batches = iter(producer_func(state_value))
+        while True:
+            started = time.monotonic()
+            try:
+                data = next(batches)
+            except StopIteration:
+                return
+            except Exception:
+                registry.record_stage(pipeline, producer_func.__name__, time.monotonic() - started, 0, None, True)
+                raise
+            registry.record_stage(pipeline, producer_func.__name__, time.monotonic() - started, 0, data)
+            yield data
+
+    return inner
+
+
+def _labels(**labels) -> str:
+    return ','.join(f'{name}="{value}"' for name, value in labels.items())
+
+
+@inject
+def render(cache: State = Provide[Container.cache_state]) -> str:
+    """Метрики в текстовом формате Prometheus"""
+
+    lines = []
+
+    def add(name: str, metric_type: str, help_: str, samples):
+        lines.append(f'# HELP {name} {help_}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.extend(f'{name}{{{labels}}} {value}' for labels, value in samples)
+
+    with registry.lock:
+        stages = sorted(registry.stages.items())
+        cycles = sorted(registry.cycles.items())
+        add('etl_stage_calls_total', 'counter', 'Stage calls (batches processed)',
+            [(_labels(pipeline=p, stage=s), stats.calls) for (p, s), stats in stages])
+        add('etl_stage_errors_total', 'counter', 'Stage calls that raised',
+            [(_labels(pipeline=p, stage=s), stats.errors) for (p, s), stats in stages])
+        add('etl_stage_seconds_total', 'counter', 'Time spent in stage',
+            [(_labels(pipeline=p, stage=s), round(stats.seconds, 6)) for (p, s), stats in stages])
+        add('etl_stage_alerts_in_total', 'counter', 'Alerts passed into stage',
+            [(_labels(pipeline=p, stage=s), stats.alerts_in) for (p, s), stats in stages])
+        add('etl_stage_alerts_out_total', 'counter', 'Alerts returned by stage by group',
+            [(_labels(pipeline=p, stage=s, group=group), count)
+             for (p, s), stats in stages for group, count in stats.alerts_out.items()])
+        add('etl_cycles_total', 'counter', 'Pipeline runs',
+            [(_labels(pipeline=p), stats.cycles) for p, stats in cycles])
+        add('etl_cycle_errors_total', 'counter', 'Pipeline runs that raised',
+            [(_labels(pipeline=p), stats.errors) for p, stats in cycles])
+        add('etl_cycle_seconds_total', 'counter', 'Time spent in pipeline runs',
+            [(_labels(pipeline=p), round(stats.seconds, 6)) for p, stats in cycles])
+        add('etl_last_cycle_seconds', 'gauge', 'Duration of the last pipeline run',
+            [(_labels(pipeline=p), round(stats.last_seconds, 6)) for p, stats in cycles])
+    add('etl_cache_negative_hits_total', 'counter', 'Cache hits on negative entries by key prefix',
+        [(_labels(prefix=prefix), count) for prefix, count in sorted(cache.negative_hits.items())])
+
+    return '\n'.join(lines) + '\n'
+
+
+def log_summary():
+    """Пишет в лог по строке на пайплайн: время и алерты на входе/выходе каждой стадии"""
+
+    with registry.lock:
+        pipelines = defaultdict(list)
+        for (pipeline, stage), stats in registry.stages.items():
+            pipelines[pipeline].append(
+                f'{stage} calls={stats.calls} avg={stats.seconds / stats.calls if stats.calls else 0:.3f}s '
+                f'in={stats.alerts_in} out={"/".join(str(stats.alerts_out[group]) for group in GROUPS)} '
+                f'errors={stats.errors}'
+            )
+        for pipeline, stages in pipelines.items():
+            cycle = registry.cycles.get(pipeline) or CycleStats()
+            logger.info('metrics %s cycles=%s last=%.3fs | %s',
+                        pipeline, cycle.cycles, cycle.last_seconds, ' | '.join(stages))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int) -> ThreadingHTTPServer:
+    """Запускает /metrics в фоновом потоке"""
+
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,81 @@
+import random
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Union
+
+from etl.logger import get_logger
+
+logger = get_logger()
+
+
+def run_periodically(func: Callable, period: Union[timedelta, float], name: str) -> threading.Thread:
+    """Запускает func сразу и затем каждые period в фоновом потоке, ошибки только логируются"""
+
+    if isinstance(period, timedelta):
+        period = period.total_seconds()
+
+    def loop():
+        while True:
+            started = time.monotonic()
+            try:
+                func()
+            except Exception:
+                logger.exception('%s failed', name)
+            time.sleep(max(0.0, period - (time.monotonic() - started)))
+
+    thread = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+class AdaptiveSchedule:
+    """
+     Пауза между проходами пайплайна по итогам прохода (etl_schema.CycleResult):
+    были полные пачки - следующий проход сразу; ничего не прочитано - пауза растёт
+    в factor раз за каждый пустой проход до max_period; иначе - base_period.
+    Время самого прохода вычитается из паузы, к паузе добавляется случайный разброс jitter.
+    """
+
+    def __init__(self, base_period: float, max_period: float, factor: float = 2, jitter: float = 0.1):
+        self.base_period = base_period
+        self.max_period = max(max_period, base_period)
+        self.factor = factor
+        self.jitter = jitter
+        self.empty_cycles = 0
+
+    def next_delay(self, stats, runtime: float) -> float:
+        if stats is not None and stats.last_batch_full:
+            self.empty_cycles = 0
+            return 0.0
+
+        if stats is not None and not stats.alerts:
+            delay = min(self.base_period * self.factor ** self.empty_cycles, self.max_period)
+            self.empty_cycles += 1
+        else:
+            self.empty_cycles = 0
+            delay = self.base_period
+
+        delay = max(0.0, delay - runtime)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+def run_adaptively(func: Callable, schedule: AdaptiveSchedule, name: str) -> threading.Thread:
+    """Запускает func в цикле с паузами по schedule, ошибки логируются и ждут base_period"""
+
+    def loop():
+        while True:
+            started = time.monotonic()
+            try:
+                stats = func()
+            except Exception:
+                logger.exception('%s failed', name)
+                schedule.empty_cycles = 0
+                stats = None
+            delay = schedule.next_delay(stats, time.monotonic() - started)
+            logger.debug('%s next run in %.1fs', name, delay)
+            time.sleep(delay)
+
+    thread = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    return thread
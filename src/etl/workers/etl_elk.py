@@ -13,31 +13,23 @@ logger = get_logger()
 @inject
 def run(
         etl_state: State = Provide[Container.etl_state]
-):
+) -> etl_schema.CycleResult:
     """Запускает пайплайн фильтров для ETL из ELK"""
 
     logger.info('started')
-    loader = etl_schema.loader_filter(
-        filter_func=filter_funcs.bulk_create_alerts
-    )
-    crafter = etl_schema.filter_(
-        target=loader,
-        filter_func=filter_funcs.craft_elk_alerts
-    )
-    alert_exist_checker = etl_schema.filter_(
-        target=crafter,
-        filter_func=filter_funcs.check_alert_existing
-    )
-    uc_is_checker = etl_schema.filter_(
-        target=alert_exist_checker,
-        filter_func=filter_funcs.uc_is_check
-    )
-    etl_schema.producer_filter(
-        target=uc_is_checker,
+    stats = etl_schema.run_pipeline(
+        stages=[
+            filter_funcs.uc_is_check,
+            filter_funcs.check_alert_existing,
+            filter_funcs.craft_elk_alerts,
+            filter_funcs.bulk_create_alerts,
+        ],
         state=etl_state,
         state_key=config.redis_ELK_etl_key,
-        update_state_value_func=filter_funcs.get_last_elk_alert_time,
-        filter_func=filter_funcs.get_last_elk_alerts
+        update_state_value_func=filter_funcs.get_last_elk_alert_position,
+        producer_func=filter_funcs.get_last_elk_alerts,
+        batch_size=int(config.elk_search_size)
     )
 
-    logger.info('finished')
+    logger.info('finished: %s', stats)
+    return stats
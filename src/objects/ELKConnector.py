@@ -1,38 +1,96 @@
-from typing import List
+from typing import List, Iterator, Optional
 
 import backoff
 from elasticsearch import Elasticsearch, exceptions
 
 from settings import config
 
+DEFAULT_PIT_KEEP_ALIVE = '5m'
+DEFAULT_TIEBREAKER_FIELD = '_id'
+SEARCH_FILTER_PATH = 'pit_id,hits.hits._id,hits.hits._source,hits.hits.sort'
+
 
 class ELKConnector:
-    def __init__(self, url, user, password, search_size: int, cert=False):
+    def __init__(self, url, user, password, search_size: int, cert=False, pit_keep_alive=DEFAULT_PIT_KEEP_ALIVE,
+                 source_fields: Optional[List[str]] = None, tiebreaker_field: str = DEFAULT_TIEBREAKER_FIELD):
         self.url = url
         self.auth = (user, password)
         self.cert = cert
-        self.search_size = search_size
+        self.search_size = int(search_size)
+        self.pit_keep_alive = pit_keep_alive
+        self.source_fields = source_fields
+        self.tiebreaker_field = tiebreaker_field
 
         self.es = Elasticsearch(self.url, http_auth=self.auth, verify_certs=self.cert, ca_certs=self.cert)
 
     @backoff.on_exception(backoff.expo,
                           exceptions.ConnectionError,
                           max_time=config.backoff_max_time)
-    def search_docs(self, index: str, query: dict) -> List[dict]:
-        result = self.es.search(
+    def search_docs(self, query: dict, index: Optional[str] = None) -> dict:
+        if self.source_fields:
+            query = dict(query, _source=self.source_fields)
+        return self.es.search(
             index=index,
             body=query,
             size=self.search_size,
-            sort='timestamp'
+            filter_path=SEARCH_FILTER_PATH
         )
-        return result.get('hits', {}).get('hits', [])
 
-    def get_gte_timestamp_query(self, timestamp: str):
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def open_point_in_time(self, index: str) -> str:
+        return self.es.open_point_in_time(index=index, keep_alive=self.pit_keep_alive)['id']
+
+    def close_point_in_time(self, pit_id: str):
+        try:
+            self.es.close_point_in_time(body={'id': pit_id})
+        except exceptions.ElasticsearchException:
+            pass
+
+    def iter_docs(self, index: str, query: dict, search_after: Optional[list] = None) -> Iterator[List[dict]]:
+        """
+            Reads documents page by page inside one point in time, sorted by (timestamp, tiebreaker field),
+            until the index is caught up. An expired point in time is reopened and reading continues.
+
+            :param index: index name
+            :param query: search body without sorting and paging
+            :param search_after: sort values of the last already processed document
+            :return: iterator of hit pages, every hit has its 'sort' values
+        """
+        pit_id = self.open_point_in_time(index)
+        try:
+            while True:
+                body = dict(query)
+                body['sort'] = [{'timestamp': 'asc'}, {self.tiebreaker_field: 'asc'}]
+                if search_after:
+                    body['search_after'] = search_after
+
+                try:
+                    result = self.search_docs(query=dict(body, pit={'id': pit_id, 'keep_alive': self.pit_keep_alive}))
+                except exceptions.NotFoundError:
+                    # point in time expired (search_context_missing)
+                    pit_id = self.open_point_in_time(index)
+                    result = self.search_docs(query=dict(body, pit={'id': pit_id, 'keep_alive': self.pit_keep_alive}))
+                pit_id = result.get('pit_id', pit_id)
+                hits = result.get('hits', {}).get('hits', [])
+                if not hits:
+                    return
+
+                yield hits
+
+                if len(hits) < self.search_size:
+                    return
+                search_after = hits[-1]['sort']
+        finally:
+            self.close_point_in_time(pit_id)
+
+    def get_gte_timestamp_query(self, timestamp: Optional[str]):
         return {
             "query": {
                 "range": {
                     "timestamp": {
-                        "gt": timestamp
+                        "gte": timestamp
                     }
                 }
             }
@@ -1,4 +1,5 @@
-from typing import List, Optional
+import time
+from typing import List, Optional, Iterable, Dict
 
 import backoff
 from PyNinox import NinoxClient
@@ -8,10 +9,22 @@ from requests import exceptions
 from settings import config
 
 
+class NinoxSchemaError(Exception):
+    """Таблица Ninox пуста или в её строках нет ожидаемого поля"""
+
+
 class NinoxConnector:
     def __init__(self, **kwargs):
         self.team = kwargs.get('team')
         self.database = kwargs.get('database')
+        # (таблица, поле, значение) -> id строки, заполняется при просмотре таблицы
+        self.row_id_index = {}
+        # (таблица, поле), которых нет ни в одной строке таблицы
+        self.missing_fields = set()
+        # (таблица, поле) -> время последнего просмотра таблицы; значения, которых не было
+        # при просмотре, считаются отсутствующими scan_ttl секунд
+        self.scanned_at = {}
+        self.scan_ttl = kwargs.get('scan_ttl', 900)
 
         self.api = NinoxClient(
             url=kwargs.get('url'),
@@ -43,6 +56,101 @@ class NinoxConnector:
 
         return [row for row in data if row.get('_table') == table_name]
 
+    @backoff.on_exception(backoff.expo,
+                          (exceptions.ConnectionError, NinoxError),
+                          max_time=config.backoff_max_time)
+    def get_table_rows(
+            self,
+            table_name: str
+    ) -> List[dict]:
+        """Возвращает все записи указанной таблицы одним запросом"""
+
+        return self.api.get_db_records(
+            self.team,
+            self.database,
+            table_name
+        )
+
+    def _scan_table(
+            self,
+            table_name: str,
+            field: str
+    ) -> Dict[str, dict]:
+        """Просматривает таблицу и заполняет индекс для всех её строк, возвращает строки по значению поля"""
+
+        table_rows = self.get_table_rows(table_name)
+        rows = [row for row in table_rows if row.get(field) is not None and '_id' in row]
+        if table_rows and not rows:
+            self.missing_fields.add((table_name, field))
+            raise NinoxSchemaError(f'no rows of table {table_name} have field {field}')
+
+        found = {}
+        for row in rows:
+            found.setdefault(str(row[field]), row)
+            self.row_id_index[(table_name, field, str(row[field]))] = str(row['_id'])
+        self.scanned_at[(table_name, field)] = time.monotonic()
+        return found
+
+    def find_many_by_field(
+            self,
+            table_name: str,
+            field: str,
+            values: Iterable[str]
+    ) -> Dict[str, dict]:
+        """Осуществляет поиск в указанной таблице по точному совпадению поля для нескольких значений
+
+        Если какого-то значения нет в индексе, таблица просматривается один раз для всех значений,
+        но не чаще раза в scan_ttl секунд: значение, которого не было при последнем просмотре, не найдено.
+        Строки значений из индекса запрашиваются по id, расхождение с индексом вызывает повторный просмотр.
+        Если в непустой таблице ни у одной строки нет поля field, выбрасывается NinoxSchemaError
+        """
+
+        if (table_name, field) in self.missing_fields:
+            raise NinoxSchemaError(f'no rows of table {table_name} have field {field}')
+
+        values = {str(value) for value in values}
+        scanned_at = self.scanned_at.get((table_name, field))
+        scan_expired = scanned_at is None or time.monotonic() - scanned_at >= self.scan_ttl
+        if scan_expired and any((table_name, field, value) not in self.row_id_index for value in values):
+            scanned = self._scan_table(table_name, field)
+            return {value: scanned[value] for value in values if value in scanned}
+
+        found = {}
+        stale = False
+        for value in values:
+            row_id = self.row_id_index.get((table_name, field, value))
+            if row_id is None:
+                continue
+            row = self.get_by_row_id(table_name, row_id)
+            if row and str(row.get(field)) == value:
+                found[value] = row
+            else:
+                self.row_id_index.pop((table_name, field, value), None)
+                stale = True
+
+        if stale:
+            scanned = self._scan_table(table_name, field)
+            found.update({value: scanned[value] for value in values - found.keys() if value in scanned})
+
+        return found
+
+    def get_by_row_ids(
+            self,
+            table_name: str,
+            row_ids: Iterable[str]
+    ) -> Dict[str, dict]:
+        """Осуществляет поиск записей таблицы по списку id одним запросом к таблице"""
+
+        row_ids = {str(row_id) for row_id in row_ids}
+        if not row_ids:
+            return {}
+
+        return {
+            str(row['_id']): row
+            for row in self.get_table_rows(table_name)
+            if str(row.get('_id')) in row_ids and len(row) >= 2
+        }
+
     def get_by_row_id(
             self,
             table_name: str,
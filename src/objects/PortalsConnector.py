@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, List
 
 import backoff
 from requests import exceptions
@@ -14,6 +14,8 @@ class PortalsConnector:
         self.password = kwargs.get('password')
         self.obtain_tokens_url = kwargs.get('obtain_tokens_url')
         self.refresh_token_url = kwargs.get('refresh_token_url')
+        self.pool_maxsize = kwargs.get('pool_maxsize', 10)
+        self.token_refresh_leeway = kwargs.get('token_refresh_leeway', 30)
         self.portal_session = None
 
     @backoff.on_exception(backoff.expo,
@@ -26,7 +28,9 @@ class PortalsConnector:
                                           refresh_token_url=self.refresh_token_url,
                                           auth_field='Authorization',
                                           auth_prefix='Bearer ',
-                                          content_type='application/json')
+                                          content_type='application/json',
+                                          pool_maxsize=self.pool_maxsize,
+                                          refresh_leeway=self.token_refresh_leeway)
 
     @backoff.on_exception(backoff.expo,
                           exceptions.ConnectionError,
@@ -48,6 +52,30 @@ class PortalsConnector:
 
         return response.json()
 
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def get_all_uc_info(self) -> List[dict]:
+        """
+            Get info from UCP about all use-case scenarios, following the listing pages
+
+            :return: use-case scenarios information
+        """
+        use_cases = []
+        url = f'{self.p_url}/usecases/api/v0/usecases/'
+        while url:
+            response = self.portal_session.request_with_token(method='get', url=url)
+            response.raise_for_status()
+            page = response.json()
+
+            if isinstance(page, list):
+                use_cases.extend(page)
+                break
+            use_cases.extend(page.get('results', []))
+            url = page.get('next')
+
+        return use_cases
+
 
 portals_connector: PortalsConnector = None
 
@@ -1,10 +1,26 @@
 import json
-from typing import Optional, List
+import threading
+import time
+from collections import deque
+from typing import Optional, List, Dict, Hashable, Iterator, Tuple
 
 import requests
-from requests import HTTPError, Request
+from requests import HTTPError, Request, Response
+from requests.adapters import HTTPAdapter
 
 DEFAULT_AQL_CHECK_PERIOD = 60
+DEFAULT_AQL_MIN_CHECK_PERIOD = 1
+DEFAULT_AQL_CHECK_PERIOD_FACTOR = 2
+DEFAULT_AQL_MAX_CONCURRENT_SEARCHES = 5
+AQL_RUNNING_STATUSES = ('WAIT', 'EXECUTE', 'SORTING')
+DEFAULT_POOL_CONNECTIONS = 1
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+
+
+class AQLSearchError(Exception):
+    pass
 
 
 class QRadarConnector:
@@ -17,19 +33,39 @@ class QRadarConnector:
         self.server_ip = kwargs.get('server_ip')
         self.verify_ssl = kwargs.get('verify_ssl')
         self.aql_check_period = kwargs.get('aql_check_period', DEFAULT_AQL_CHECK_PERIOD)
+        self.aql_min_check_period = kwargs.get('aql_min_check_period', DEFAULT_AQL_MIN_CHECK_PERIOD)
+        self.aql_max_concurrent_searches = \
+            kwargs.get('aql_max_concurrent_searches', DEFAULT_AQL_MAX_CONCURRENT_SEARCHES)
+        # shared by all threads using the connector, one slot per search created on the console
+        self.aql_search_slots = threading.BoundedSemaphore(self.aql_max_concurrent_searches)
+        self.timeout = (
+            kwargs.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+            kwargs.get('read_timeout', DEFAULT_READ_TIMEOUT)
+        )
 
         self.logger = kwargs.get('logger')
 
+        # urllib3 pool is thread-safe, so one session is shared by all threads (e.g. dramatiq workers)
+        self.session = requests.Session()
+        self.session.verify = self.verify_ssl
+        adapter = HTTPAdapter(
+            pool_connections=kwargs.get('pool_connections', DEFAULT_POOL_CONNECTIONS),
+            pool_maxsize=kwargs.get('pool_maxsize', DEFAULT_POOL_MAXSIZE),
+            pool_block=True
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
     @staticmethod
     def get_log_source_filter(log_source_names: List[str]) -> str:
         return ' or '.join([f'name="{name}"' for name in log_source_names if name])
 
-    def __request(
+    def __send(
             self,
             method: str,
             url: str,
             **kwargs
-    ):
+    ) -> Optional[Response]:
         headers = dict(self.headers)
         if 'headers' in kwargs and isinstance(kwargs['headers'], dict):
             headers.update(kwargs['headers'])
@@ -41,30 +77,42 @@ class QRadarConnector:
             headers=headers,
             **kwargs
         )
-        prepped = request.prepare()
+        prepped = self.session.prepare_request(request)
 
-        with requests.Session() as session:
-            session.verify = self.verify_ssl
-            try:
-                response = session.send(prepped)
-                response.raise_for_status()
-                try:
-                    return response.json()
-                except json.decoder.JSONDecodeError:
-                    return response.text
-            except HTTPError as e:
-                if e.response.status_code == 404:
-                    return None
-                raise e
-
-    def __get_rows(
+        try:
+            response = self.session.send(prepped, timeout=self.timeout)
+            response.raise_for_status()
+            return response
+        except HTTPError as e:
+            if e.response.status_code == 404:
+                return None
+            raise e
+
+    @staticmethod
+    def __parse(response: Optional[Response]):
+        if response is None:
+            return None
+        try:
+            return response.json()
+        except json.decoder.JSONDecodeError:
+            return response.text
+
+    def __request(
+            self,
+            method: str,
+            url: str,
+            **kwargs
+    ):
+        return self.__parse(self.__send(method, url, **kwargs))
+
+    def __get_rows_page(
             self,
             url: str,
             fields: Optional[str] = None,
             filter_: Optional[str] = None,
             sort: Optional[str] = None,
             range_: Optional[str] = None
-    ) -> List[dict]:
+    ) -> Tuple[List[dict], Optional[int]]:
         try:
             params = {}
             if fields:
@@ -76,12 +124,26 @@ class QRadarConnector:
             headers = {}
             if range_:
                 headers['Range'] = range_
-            return self.__request(method='get', url=url, headers=headers, params=params)
+            response = self.__send(method='get', url=url, headers=headers, params=params)
+            return self.__parse(response), self.get_content_range_total(response)
         except Exception as e:
             self.logger.error('(url=\'%s\', fields=\'%s\', filter=\'%s\', sort=\'%s\', range=\'%s\') failed - %s',
                               url, fields, filter_, sort, range_, e)
             raise
 
+    def __get_rows(self, url: str, **kwargs) -> List[dict]:
+        return self.__get_rows_page(url, **kwargs)[0]
+
+    @staticmethod
+    def get_content_range_total(response: Optional[Response]) -> Optional[int]:
+        """Parses the total number of items from the 'Content-Range: items 0-49/1234' header"""
+
+        if response is None:
+            return None
+        content_range = response.headers.get('Content-Range', '')
+        _, _, total = content_range.rpartition('/')
+        return int(total) if total.isdigit() else None
+
     def __get_row(
             self,
             url: str,
@@ -103,6 +165,14 @@ class QRadarConnector:
             **kwargs
         )
 
+    def get_offenses_page(self, **kwargs) -> Tuple[List[dict], Optional[int]]:
+        """Returns requested offenses and the total number of offenses matching the filter"""
+
+        return self.__get_rows_page(
+            url=f'https://{self.server_ip}/api/siem/offenses',
+            **kwargs
+        )
+
     def get_source_addresses(self, **kwargs) -> List[dict]:
         return self.__get_rows(
             url=f'https://{self.server_ip}/api/siem/source_addresses',
@@ -164,26 +234,85 @@ class QRadarConnector:
 
         return self.__request(method='get', url=url, headers=headers)
 
+    def __delete_search(
+            self,
+            search_id: str,
+    ):
+        url = f'https://{self.server_ip}/api/ariel/searches/{search_id}'
+
+        return self.__request(method='delete', url=url)
+
     def aql_search(
             self,
             query: str
     ) -> dict:
-        search = {}
-        try:
-            search = self.__create_search(query)
-
-            while search['status'] != 'COMPLETED':
-                if (search['status'] == 'EXECUTE') | \
-                        (search['status'] == 'SORTING') | \
-                        (search['status'] == 'WAIT'):
-                    search = self.__get_search(search['search_id'])
-                    time.sleep(self.aql_check_period)
-
-            return self.__get_search_results(search['search_id'])
+        for _, result in self.aql_search_many({query: query}):
+            return result
 
-        except Exception as e:
-            self.logger.error('search_id=\'%s\' query=(%s) failed - %s', search.get('search_id'), query, e)
-            raise
+    def aql_search_many(
+            self,
+            queries: Dict[Hashable, str]
+    ) -> Iterator[Tuple[Hashable, dict]]:
+        """
+            Run AQL searches concurrently, keeping at most aql_max_concurrent_searches running on the console
+            across all threads using the connector.
+            Each search is polled with its own interval, which grows from aql_min_check_period
+            up to aql_check_period.
+
+            :param queries: AQL queries by arbitrary keys
+            :return: (key, search results) pairs in order of completion
+        """
+        pending = deque(queries.items())
+        running = {}
+        try:
+            while pending or running:
+                # wait for a slot only when there is nothing of our own to poll
+                while pending and self.aql_search_slots.acquire(blocking=not running):
+                    key, query = pending.popleft()
+                    try:
+                        search = self.__create_search(query)
+                    except Exception as e:
+                        self.aql_search_slots.release()
+                        self.logger.error('query=(%s) failed - %s', query, e)
+                        raise
+                    running[search['search_id']] = {
+                        'key': key,
+                        'query': query,
+                        'period': self.aql_min_check_period,
+                        'check_at': time.monotonic() + self.aql_min_check_period
+                    }
+
+                time.sleep(max(0, min(item['check_at'] for item in running.values()) - time.monotonic()))
+
+                for search_id, item in list(running.items()):
+                    if item['check_at'] > time.monotonic():
+                        continue
+                    try:
+                        search = self.__get_search(search_id)
+                        if search['status'] == 'COMPLETED':
+                            result = self.__get_search_results(search_id)
+                        elif search['status'] in AQL_RUNNING_STATUSES:
+                            item['period'] = min(item['period'] * DEFAULT_AQL_CHECK_PERIOD_FACTOR,
+                                                 self.aql_check_period)
+                            item['check_at'] = time.monotonic() + item['period']
+                            continue
+                        else:
+                            raise AQLSearchError(f'search status {search["status"]} - '
+                                                 f'{search.get("error_messages")}')
+                    except Exception as e:
+                        self.logger.error('search_id=\'%s\' query=(%s) failed - %s', search_id, item['query'], e)
+                        raise
+                    del running[search_id]
+                    self.aql_search_slots.release()
+                    yield item['key'], result
+        finally:
+            for search_id in running:
+                try:
+                    self.__delete_search(search_id)
+                except Exception as e:
+                    self.logger.warning('search_id=\'%s\' deletion failed - %s', search_id, e)
+                finally:
+                    self.aql_search_slots.release()
 
     def edit_offense(
             self,
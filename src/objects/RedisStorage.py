@@ -1,25 +1,36 @@
-import json
+import uuid
 from datetime import timedelta
-from typing import Any, Optional
+from typing import Any, Optional, Dict, List, Tuple
 
 import backoff
 from redis import Redis, exceptions
 
+from objects.redis_codec import Codec, JsonCodec
 from settings import config
 
+# снимает блокировку, только если она всё ещё принадлежит владельцу токена
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
 
 class RedisStorage:
-    def __init__(self, host: str):
+    def __init__(self, host: str, codec: Optional[Codec] = None):
         self.redis_adapter = Redis(host=host)
+        self.codec = codec or JsonCodec()
+        self.release_lock_script = self.redis_adapter.register_script(RELEASE_LOCK_SCRIPT)
 
     @backoff.on_exception(backoff.expo,
                           exceptions.ConnectionError,
                           max_time=config.backoff_max_time)
     def save_value(self, key: str, value: Any, ttl: Optional[timedelta] = None):
         if ttl:
-            self.redis_adapter.setex(key, ttl, json.dumps(value))
+            self.redis_adapter.setex(key, ttl, self.codec.encode(value))
         else:
-            self.redis_adapter.set(key, json.dumps(value))
+            self.redis_adapter.set(key, self.codec.encode(value))
 
     @backoff.on_exception(backoff.expo,
                           exceptions.ConnectionError,
@@ -28,7 +39,123 @@ class RedisStorage:
         raw_data = self.redis_adapter.get(key)
         if raw_data is None:
             return None
-        return json.loads(raw_data)
+        return self.codec.decode(raw_data)
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def save_values(self, mapping: Dict[str, Any], ttl: Optional[timedelta] = None):
+        if not mapping:
+            return
+        if not ttl:
+            self.redis_adapter.mset({key: self.codec.encode(value) for key, value in mapping.items()})
+            return
+        pipeline = self.redis_adapter.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipeline.setex(key, ttl, self.codec.encode(value))
+        pipeline.execute()
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def retrieve_values_with_ttl(self, keys: List[str]) -> List[Tuple[Any, Optional[float]]]:
+        if not keys:
+            return []
+        pipeline = self.redis_adapter.pipeline(transaction=False)
+        for key in keys:
+            pipeline.get(key)
+            pipeline.pttl(key)
+        response = pipeline.execute()
+
+        values = []
+        for raw_data, ttl in zip(response[::2], response[1::2]):
+            if raw_data is None:
+                values.append((None, None))
+            else:
+                values.append((self.codec.decode(raw_data), ttl / 1000 if ttl >= 0 else None))
+        return values
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def save_value_if_absent(self, key: str, value: Any) -> bool:
+        return bool(self.redis_adapter.set(key, self.codec.encode(value), nx=True))
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def add_to_sorted_set(self, key: str, members: Dict[str, float], min_score: Optional[float] = None):
+        pipeline = self.redis_adapter.pipeline()
+        pipeline.zadd(key, members)
+        if min_score is not None:
+            pipeline.zremrangebyscore(key, '-inf', f'({min_score}')
+        pipeline.execute()
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def retrieve_sorted_set_scores(self, key: str, members: List[str]) -> List[Optional[float]]:
+        pipeline = self.redis_adapter.pipeline(transaction=False)
+        for member in members:
+            pipeline.zscore(key, member)
+        return pipeline.execute()
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def save_hash_values(self, key: str, mapping: Dict[str, Any]):
+        if mapping:
+            self.redis_adapter.hset(
+                key,
+                mapping={field: self.codec.encode(value) for field, value in mapping.items()}
+            )
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def retrieve_hash_values(self, key: str, fields: List[str]) -> List[Any]:
+        if not fields:
+            return []
+        return [self.codec.decode(raw_data) if raw_data is not None else None
+                for raw_data in self.redis_adapter.hmget(key, fields)]
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def retrieve_hash_fields(self, key: str) -> List[str]:
+        return [field.decode() for field in self.redis_adapter.hkeys(key)]
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def delete_hash_fields(self, key: str, fields: List[str]):
+        if fields:
+            self.redis_adapter.hdel(key, *fields)
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def acquire_locks(self, keys: List[str], ttl: timedelta) -> Dict[str, str]:
+        """Берёт блокировки SET NX PX, возвращает токены взятых блокировок"""
+
+        if not keys:
+            return {}
+        tokens = {key: uuid.uuid4().hex for key in keys}
+        pipeline = self.redis_adapter.pipeline(transaction=False)
+        for key, token in tokens.items():
+            pipeline.set(key, token, nx=True, px=int(ttl.total_seconds() * 1000))
+        return {key: token for (key, token), acquired in zip(tokens.items(), pipeline.execute()) if acquired}
+
+    @backoff.on_exception(backoff.expo,
+                          exceptions.ConnectionError,
+                          max_time=config.backoff_max_time)
+    def release_locks(self, tokens: Dict[str, str]):
+        if not tokens:
+            return
+        pipeline = self.redis_adapter.pipeline(transaction=False)
+        for key, token in tokens.items():
+            self.release_lock_script(keys=[key], args=[token], client=pipeline)
+        pipeline.execute()
 
 
 redis_storage: RedisStorage = None
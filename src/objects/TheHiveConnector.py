@@ -1,8 +1,16 @@
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Iterable, List, Set
 
-from requests import HTTPError
+import requests
+from requests import HTTPError, Response
+from requests.adapters import HTTPAdapter
 from thehive4py.api import TheHiveApi
-from thehive4py.models import Alert, CustomFieldHelper
+from thehive4py.models import Alert, CustomFieldHelper, Version
+from thehive4py.query import Or, Eq
+
+DEFAULT_SEARCH_CHUNK_SIZE = 100
+DEFAULT_SEARCH_CONCURRENCY = 4
+DEFAULT_CREATE_CONCURRENCY = 4
 
 
 class TheHiveConnector:
@@ -13,6 +21,17 @@ class TheHiveConnector:
         self.lpagetest_api_key = kwargs.get('lpagetest_api_key')
         self.cert = kwargs.get('cert', True)
         self.logger = kwargs.get('logger')
+        self.search_chunk_size = kwargs.get('search_chunk_size', DEFAULT_SEARCH_CHUNK_SIZE)
+        self.search_executor = ThreadPoolExecutor(
+            max_workers=kwargs.get('search_concurrency', DEFAULT_SEARCH_CONCURRENCY),
+            thread_name_prefix='thehive_search'
+        )
+        self.create_concurrency = kwargs.get('create_concurrency', DEFAULT_CREATE_CONCURRENCY)
+
+        # non-blocking pool: create_alerts bounds its own fan-out, surplus connections are just not reused
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=self.create_concurrency))
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=self.create_concurrency))
 
         self.apis = {
             'L1': TheHiveApi(self.url, self.l1_api_key, cert=self.cert),
@@ -26,6 +45,24 @@ class TheHiveConnector:
             raise ValueError(f'invalid organisation {organisation}')
         return api
 
+    def _post_alert(self, api: TheHiveApi, alert_object: Alert) -> Response:
+        """
+            Same request as TheHiveApi.create_alert, but sent over the pooled session
+        """
+        to_exclude = ['id']
+        if api.version is Version.THEHIVE_3.value:
+            to_exclude.append('pap')
+            to_exclude.append('externalLink')
+
+        return self.session.post(
+            f'{self.url}/api/alert',
+            headers={'Content-Type': 'application/json'},
+            data=alert_object.jsonify(excludes=to_exclude),
+            proxies=api.proxies,
+            auth=api.auth,
+            verify=self.cert
+        )
+
     def create_alert(self, alert_data: dict, organisation: str) -> Optional[dict]:
         alert_object = Alert(**alert_data)
 
@@ -35,7 +72,7 @@ class TheHiveConnector:
 
         api = self._get_api(organisation)
 
-        response = api.create_alert(alert_object)
+        response = self._post_alert(api, alert_object)
 
         try:
             response.raise_for_status()
@@ -49,6 +86,22 @@ class TheHiveConnector:
         self.logger.info('alert %s created', alert_object.sourceRef)
         return response.json()
 
+    def create_alerts(self, alerts_data: List[dict], organisation: str) -> List[Optional[Exception]]:
+        """
+            Create several alerts over the pooled session, at most create_concurrency at a time
+
+            :return: error of every alert, None if the alert was created or already exists
+        """
+        def create(alert_data: dict) -> Optional[Exception]:
+            try:
+                self.create_alert(alert_data, organisation)
+            except Exception as e:
+                return e
+            return None
+
+        with ThreadPoolExecutor(max_workers=self.create_concurrency, thread_name_prefix='thehive_create') as executor:
+            return list(executor.map(create, alerts_data))
+
     def craft_custom_fields(self, custom_fields_dict: dict) -> dict:
         """
             Create custom fields as objects
@@ -76,10 +129,13 @@ class TheHiveConnector:
 
         return custom_fields.build()
 
-    def find_alerts(self, query, organisation: str) -> list:
+    def find_alerts(self, query, organisation: str, range_: Optional[str] = None) -> list:
         api = self._get_api(organisation)
 
-        response = api.find_alerts(query=query)
+        if range_:
+            response = api.find_alerts(query=query, range=range_)
+        else:
+            response = api.find_alerts(query=query)
 
         try:
             response.raise_for_status()
@@ -88,3 +144,32 @@ class TheHiveConnector:
             raise e
 
         return response.json()
+
+    def find_existing_source_refs(self, source_refs: Iterable[str], organisations: List[str]) -> Set[str]:
+        """
+            Find which of the sourceRefs already exist in any of the organisations.
+            The refs are split into chunks of search_chunk_size and every (chunk, organisation) query runs
+            concurrently, so the call takes about as long as the slowest single query
+        """
+        source_refs = list(source_refs)
+        chunks = [source_refs[i:i + self.search_chunk_size] for i in range(0, len(source_refs), self.search_chunk_size)]
+        futures = [
+            self.search_executor.submit(self._find_chunk_source_refs, chunk, organisation)
+            for organisation in organisations
+            for chunk in chunks
+        ]
+
+        existing_source_refs = set()
+        for future in futures:
+            existing_source_refs |= future.result()
+        return existing_source_refs
+
+    def _find_chunk_source_refs(self, source_refs: List[str], organisation: str) -> Set[str]:
+        # sourceRef is unique within an organisation, so the range never cuts off a match;
+        # _search has no field selection, so everything but sourceRef is dropped right away
+        alerts = self.find_alerts(
+            query=Or(*[Eq('sourceRef', source_ref) for source_ref in source_refs]),
+            organisation=organisation,
+            range_=f'0-{len(source_refs)}'
+        )
+        return {alert.get('sourceRef') for alert in alerts}
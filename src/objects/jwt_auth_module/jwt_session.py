@@ -1,4 +1,9 @@
+import base64
+import threading
+import time
+
 import requests, json
+from requests.adapters import HTTPAdapter
 
 
 class AuthenticationError(Exception):
@@ -32,11 +37,13 @@ class JWT_Session:
         * auth_field - поле заголовка запроса, в который подставляется access токен, по умолчанию 'Authorization'
         * auth_prefix - префикс, добавляемый перед access token в поле заголовка, по умолчанию 'Bearer '
         * content_type - значение заголовка Content-Type, по умолчанию 'application/json'
+        * pool_maxsize - размер пула соединений сессии, по умолчанию 10
+        * refresh_leeway - за сколько секунд до истечения (claim exp) обновлять access токен, по умолчанию 30
 
     """
 
     def __init__(self, username, password, obtain_tokens_url, refresh_token_url, auth_field='Authorization',
-                 auth_prefix='Bearer ', content_type='application/json'):
+                 auth_prefix='Bearer ', content_type='application/json', pool_maxsize=10, refresh_leeway=30):
         """
         Конструктор класса
         методом __obtain_jwt_tokens__() получает от сервера токены в обмен на предоставленные креды
@@ -46,6 +53,11 @@ class JWT_Session:
         self.password = password
         self.obtain_tokens_url = obtain_tokens_url
         self.refresh_token_url = refresh_token_url
+        self.refresh_leeway = refresh_leeway
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_maxsize))
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=pool_maxsize))
+        self.lock = threading.Lock()
         self.__obtain_jwt_tokens__()
         self.content_type = content_type
         self.auth_prefix = auth_prefix
@@ -58,8 +70,8 @@ class JWT_Session:
         Сохраняет полученные access и refresh токены в атрибуты
 
         """
-        r = requests.request(method='post', url=self.obtain_tokens_url,
-                             data={'username': self.username, 'password': self.password})
+        r = self.session.request(method='post', url=self.obtain_tokens_url,
+                                 data={'username': self.username, 'password': self.password})
         if r.status_code != 200:
             if message:
                 message = '\n'.join([message,
@@ -73,6 +85,7 @@ class JWT_Session:
                                       message=f"Failed to obtain jwt tokens from a provided URL, server returned {r.json()}")
         self.refresh_token = refresh_token
         self.access_token = access_token
+        self.access_token_exp = self.__get_token_exp__(access_token)
 
     def __refresh_access_token__(self):
         """
@@ -84,11 +97,11 @@ class JWT_Session:
                           если в запросе нет поля access или оно пустое, выкидывает ошибку
 
         """
-        r = requests.request(method='post', url=self.refresh_token_url, data={'refresh': self.refresh_token})
+        r = self.session.request(method='post', url=self.refresh_token_url, data={'refresh': self.refresh_token})
         if r.status_code == 401:
             self.__obtain_jwt_tokens__(
                 message=f"Failed to obtain jwt access token from a provided URL, server responded with code {r.status_code}: {r.json()}")
-            r = requests.request(method='post', url=self.refresh_token_url, data={'refresh': self.refresh_token})
+            r = self.session.request(method='post', url=self.refresh_token_url, data={'refresh': self.refresh_token})
         elif r.status_code != 200:
             raise AuthenticationError(url=self.refresh_token_url,
                                       message=f"Failed to refresh access tokens from a provided URL, server returned {r.json()}")
@@ -98,6 +111,37 @@ class JWT_Session:
             raise AuthenticationError(url=self.refresh_token_url,
                                       message=f"Failed to obtain jwt access token from a provided URL, server returned {r.json()}")
         self.access_token = access_token
+        self.access_token_exp = self.__get_token_exp__(access_token)
+
+    @staticmethod
+    def __get_token_exp__(token):
+        """
+        Возвращает claim exp из payload JWT токена (подпись не проверяется) или None, если его нет
+
+        """
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        except (IndexError, ValueError, AttributeError):
+            return None
+
+    def __ensure_access_token__(self, stale_token=None):
+        """
+        Обновляет access токен, если он истекает в ближайшие refresh_leeway секунд или равен stale_token
+        Обновление происходит под блокировкой: параллельные запросы ждут одно обновление, а не делают каждый своё
+
+        """
+        def needs_refresh():
+            if stale_token is not None and self.access_token == stale_token:
+                return True
+            return self.access_token_exp is not None and self.access_token_exp - time.time() < self.refresh_leeway
+
+        if not needs_refresh():
+            return
+        with self.lock:
+            if needs_refresh():
+                self.__refresh_access_token__()
 
     def request_with_token(self, method, url, extra_headers=None, body=False):
         """
@@ -111,13 +155,15 @@ class JWT_Session:
             * body - тело запроса, по умолчанию False
 
         """
-        headers = {f'{self.auth_field}': f'{self.auth_prefix}{self.access_token}', 'Content-Type': self.content_type}
+        self.__ensure_access_token__()
+        access_token = self.access_token
+        headers = {f'{self.auth_field}': f'{self.auth_prefix}{access_token}', 'Content-Type': self.content_type}
         if not extra_headers:
             extra_headers = {}
         headers.update(extra_headers)
-        r = requests.request(method=method, url=url, headers=headers, data=body)
+        r = self.session.request(method=method, url=url, headers=headers, data=body)
         if r.status_code == 401:
-            self.__refresh_access_token__()
+            self.__ensure_access_token__(stale_token=access_token)
             headers.update({f'{self.auth_field}': f'{self.auth_prefix}{self.access_token}'})
-            r = requests.request(method=method, url=url, headers=headers, data=body)
+            r = self.session.request(method=method, url=url, headers=headers, data=body)
         return r
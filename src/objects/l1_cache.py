@@ -0,0 +1,45 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+
+class L1Cache:
+    """
+     Ограниченный кэш в памяти процесса. При превышении max_entries вытесняются
+    давно не использованные записи (LRU), истёкшие записи удаляются при обращении.
+    Время считается по монотонным часам, доступ потокобезопасен.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_with_ttl(self, key: str) -> Tuple[Any, Optional[float]]:
+        """Получить значение и оставшееся время жизни в секундах, (None, None) - если его нет или оно истекло"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None, None
+            expires_at, value = entry
+            now = time.monotonic()
+            if expires_at is not None and expires_at <= now:
+                del self.entries[key]
+                return None, None
+            self.entries.move_to_end(key)
+            return value, expires_at - now if expires_at is not None else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """Сохранить значение на ttl секунд, без ttl - до вытеснения"""
+
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,106 @@
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from objects.NinoxConnector import NinoxConnector, NinoxSchemaError
+from objects.RedisStorage import RedisStorage
+
+
+class NinoxSnapshot:
+    """
+     Копия таблиц ИС и IS-UC из Ninox в Redis. Каждая ИС хранится в hash по её id
+    в том же виде, что и в кэше IS: строка ИС, в которой ссылки на IS-UC заменены
+    самими строками IS-UC.
+     Таблицы при обновлении читаются целиком (клиент Ninox не умеет отдавать только
+    изменённые строки), инкрементальна только запись: перезаписываются ИС, у которых
+    по времени модификации изменилась строка или связанные строки IS-UC либо изменился
+    набор связанных строк IS-UC, удалённые ИС удаляются.
+     Пустая таблица ИС или строки без поля is_id_field не публикуются: обновление
+    завершается NinoxSchemaError, прежний снимок устаревает и перестаёт использоваться.
+    """
+
+    def __init__(
+            self,
+            storage: RedisStorage,
+            key_prefix: str,
+            is_table: str,
+            is_uc_table: str,
+            is_id_field: str,
+            modified_field: str,
+            max_age: timedelta
+    ):
+        self.storage = storage
+        self.is_key = f'{key_prefix}IS'
+        # id связанных строк IS-UC, с которыми ИС записана в снимок
+        self.links_key = f'{key_prefix}IS_links'
+        self.meta_key = f'{key_prefix}meta'
+        self.is_table = is_table
+        self.is_uc_table = is_uc_table
+        self.is_id_field = is_id_field
+        self.modified_field = modified_field
+        self.max_age = max_age
+
+    def refresh(self, ninox_connector: NinoxConnector) -> int:
+        """Обновить снимок, возвращает количество перезаписанных ИС"""
+
+        is_rows = ninox_connector.get_table_rows(self.is_table)
+        if not is_rows:
+            raise NinoxSchemaError(f'table {self.is_table} is empty, snapshot is not updated')
+        keyed_rows = {str(row[self.is_id_field]): row for row in is_rows if row.get(self.is_id_field)}
+        if not keyed_rows:
+            raise NinoxSchemaError(
+                f'no rows of table {self.is_table} have field {self.is_id_field}, snapshot is not updated'
+            )
+
+        is_uc_rows = {
+            str(row['_id']): row
+            for row in ninox_connector.get_table_rows(self.is_uc_table)
+            if '_id' in row and len(row) >= 2
+        }
+        meta = self.storage.retrieve_value(self.meta_key) or {}
+        last_modified = meta.get('modified')
+        previous_links = dict(zip(keyed_rows, self.storage.retrieve_hash_values(self.links_key, list(keyed_rows))))
+
+        information_systems = {}
+        links = {}
+        modified = last_modified
+        for key, row in keyed_rows.items():
+            information_system = dict(row)
+            linked_ids = [str(row_id) for row_id in row.get(self.is_uc_table) or [] if str(row_id) in is_uc_rows]
+            if row.get(self.is_uc_table):
+                information_system[self.is_uc_table] = [is_uc_rows[row_id] for row_id in linked_ids]
+
+            row_modified = self._get_modified([row] + (information_system.get(self.is_uc_table) or []))
+            if last_modified is None or row_modified is None or row_modified > last_modified \
+                    or previous_links.get(key) != linked_ids:
+                information_systems[key] = information_system
+                links[key] = linked_ids
+            if row_modified is not None and (modified is None or row_modified > modified):
+                modified = row_modified
+
+        self.storage.save_hash_values(self.is_key, information_systems)
+        self.storage.save_hash_values(self.links_key, links)
+        for hash_key in (self.is_key, self.links_key):
+            self.storage.delete_hash_fields(
+                hash_key,
+                [key for key in self.storage.retrieve_hash_fields(hash_key) if key not in keyed_rows]
+            )
+        self.storage.save_value(self.meta_key, {'modified': modified, 'refreshed_at': time.time()})
+
+        return len(information_systems)
+
+    def _get_modified(self, rows: List[dict]):
+        values = [row.get(self.modified_field) for row in rows]
+        if not values or None in values:
+            return None
+        return max(values)
+
+    def get_information_systems(self, keys: List[str]) -> Optional[Dict[str, Optional[dict]]]:
+        """Получить ИС из снимка; None, если снимок не загружен или устарел"""
+
+        meta = self.storage.retrieve_value(self.meta_key)
+        if not meta or time.time() - meta.get('refreshed_at', 0) > self.max_age.total_seconds():
+            return None
+
+        keys = [str(key) for key in keys]
+        return dict(zip(keys, self.storage.retrieve_hash_values(self.is_key, keys)))
@@ -0,0 +1,54 @@
+import json
+import zlib
+from abc import ABC, abstractmethod
+from typing import Any
+
+import msgpack
+
+# первый байт значения - версия формата; значения без тега - JSON, записанный до появления кодеков
+MSGPACK_TAG = b'\x01'
+MSGPACK_ZLIB_TAG = b'\x02'
+
+
+class Codec(ABC):
+    """Преобразование значений для хранения в Redis, читаются значения всех форматов"""
+
+    @abstractmethod
+    def encode(self, value: Any) -> bytes:
+        pass
+
+    def decode(self, raw_data: bytes) -> Any:
+        if raw_data[:1] == MSGPACK_TAG:
+            return msgpack.unpackb(raw_data[1:], raw=False, strict_map_key=False)
+        if raw_data[:1] == MSGPACK_ZLIB_TAG:
+            return msgpack.unpackb(zlib.decompress(raw_data[1:]), raw=False, strict_map_key=False)
+        return json.loads(raw_data)
+
+
+class JsonCodec(Codec):
+    """Записывает значения JSON-текстом без тега, как до появления кодеков"""
+
+    def encode(self, value: Any) -> bytes:
+        return json.dumps(value).encode()
+
+
+class MsgpackCodec(Codec):
+    """Записывает значения в msgpack, значения больше compress_threshold байт дополнительно сжимаются zlib"""
+
+    def __init__(self, compress_threshold: int = 0, compress_level: int = 1):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, value: Any) -> bytes:
+        packed = msgpack.packb(value, use_bin_type=True)
+        if self.compress_threshold and len(packed) > self.compress_threshold:
+            return MSGPACK_ZLIB_TAG + zlib.compress(packed, self.compress_level)
+        return MSGPACK_TAG + packed
+
+
+def make_codec(name: str, compress_threshold: int = 0) -> Codec:
+    if name == 'json':
+        return JsonCodec()
+    if name == 'msgpack':
+        return MsgpackCodec(compress_threshold)
+    raise ValueError(f'unknown redis codec {name}')
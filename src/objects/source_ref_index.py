@@ -0,0 +1,51 @@
+import time
+from datetime import timedelta
+from typing import Iterable, List, Set, Tuple
+
+from objects.RedisStorage import RedisStorage
+
+
+class SourceRefIndex:
+    """
+     Индекс sourceRef алертов, которые уже поставлены в очередь на создание
+    или найдены в TheHive. Для каждого источника хранится sorted set в Redis,
+    score - время добавления, записи старше window удаляются.
+
+     Пока индекс источника моложе warmup, отсутствие sourceRef в нём ничего
+    не гарантирует и такие алерты нужно проверять в TheHive.
+    """
+
+    def __init__(self, storage: RedisStorage, key_prefix: str, window: timedelta, warmup: timedelta):
+        self.storage = storage
+        self.key_prefix = key_prefix
+        self.window = window
+        self.warmup = warmup
+
+    def add(self, source: str, source_refs: Iterable[str]) -> None:
+        """Запомнить sourceRef алертов источника"""
+
+        now = time.time()
+        members = dict.fromkeys(source_refs, now)
+        if not members:
+            return
+        self.storage.save_value_if_absent(f'{self.key_prefix}{source}:since', now)
+        self.storage.add_to_sorted_set(
+            f'{self.key_prefix}{source}',
+            members,
+            min_score=now - self.window.total_seconds()
+        )
+
+    def split(self, source: str, source_refs: List[str]) -> Tuple[Set[str], Set[str]]:
+        """Разделить sourceRef на известные и требующие проверки в TheHive"""
+
+        scores = self.storage.retrieve_sorted_set_scores(f'{self.key_prefix}{source}', source_refs)
+        min_score = time.time() - self.window.total_seconds()
+        known = {source_ref for source_ref, score in zip(source_refs, scores) if score and score >= min_score}
+
+        if self.is_warm(source):
+            return known, set()
+        return known, set(source_refs) - known
+
+    def is_warm(self, source: str) -> bool:
+        since = self.storage.retrieve_value(f'{self.key_prefix}{source}:since')
+        return since is not None and time.time() - since >= self.warmup.total_seconds()
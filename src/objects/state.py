@@ -1,47 +1,96 @@
-import datetime
+from collections import Counter
 from datetime import timedelta
-from typing import Any, Optional
+from typing import Any, Optional, Dict, List, Tuple
 
 from objects.RedisStorage import RedisStorage
+from objects.l1_cache import L1Cache
+
+DEFAULT_MAX_LOCAL_ENTRIES = 10000
+# значение-маркер для ключей, которых нет в источнике (негативное кэширование)
+NEGATIVE_VALUE = {'__missing__': True}
 
 
 class State:
     """
      Класс для хранения состояния при работе с данными, чтобы постоянно
     не перечитывать данные с начала.
-    Здесь представлена реализация с сохранением состояния в файл.
-    В целом ничего не мешает поменять это поведение на работу с БД или
-    распределённым хранилищем.
+    Здесь представлена реализация с сохранением состояния в Redis и
+    ограниченным кэшем в памяти процесса перед ним: значения, прочитанные
+    из Redis, хранятся в памяти ровно столько, сколько им осталось жить в Redis.
+    Если задан soft_ttl, значение старше soft_ttl считается устаревшим, но
+    ещё отдаётся до истечения ttl, пока его обновляют в фоне.
     """
 
-    def __init__(self, storage: RedisStorage, ttl: Optional[timedelta] = None):
+    def __init__(
+            self,
+            storage: RedisStorage,
+            ttl: Optional[timedelta] = None,
+            max_local_entries: int = DEFAULT_MAX_LOCAL_ENTRIES,
+            soft_ttl: Optional[timedelta] = None
+    ):
         self.storage = storage
         self.ttl = ttl
-        self.state = {}
+        self.soft_ttl = soft_ttl
+        self.state = L1Cache(max_local_entries)
+        # количество попаданий в негативный кэш по префиксам ключей
+        self.negative_hits = Counter()
+
+    def set_state(self, key: str, value: Any, ttl: Optional[timedelta] = None) -> None:
+        """Установить состояние для определённого ключа, ttl переопределяет ttl по умолчанию"""
+
+        self.set_states({key: value}, ttl)
 
-    def set_state(self, key: str, value: Any) -> None:
-        """Установить состояние для определённого ключа"""
+    def set_states(self, mapping: Dict[str, Any], ttl: Optional[timedelta] = None) -> None:
+        """Установить состояния для нескольких ключей одним запросом к хранилищу"""
 
-        if self.ttl:
-            self.state[key] = (datetime.datetime.now() + self.ttl, value)
-        else:
-            self.state[key] = value
-        self.storage.save_value(key, value, self.ttl)
+        if not mapping:
+            return
+        ttl = ttl or self.ttl
+        for key, value in mapping.items():
+            self.state.set(key, value, ttl.total_seconds() if ttl else None)
+        self.storage.save_values(mapping, ttl)
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу"""
 
-        value = self.state.get(key)
-        if value and self.ttl:
-            if value[0] > datetime.datetime.now():
-                return value[1]
+        return self.get_states([key])[key]
+
+    def get_states(self, keys: List[str]) -> Dict[str, Any]:
+        """Получить состояния нескольких ключей, отсутствующие в памяти - одним запросом к хранилищу"""
+
+        return {key: value for key, (value, _) in self.get_states_with_ttl(keys).items()}
+
+    def get_states_with_ttl(self, keys: List[str]) -> Dict[str, Tuple[Any, Optional[float]]]:
+        """Получить состояния нескольких ключей вместе с оставшимся временем жизни в секундах"""
+
+        states = {}
+        missing_keys = []
+        for key in keys:
+            value, ttl = self.state.get_with_ttl(key)
+            if value:
+                states[key] = value, ttl
             else:
-                del self.state[key]
-                return None
-        elif value:
-            return value
+                missing_keys.append(key)
+
+        states.update(self.get_stored_states_with_ttl(missing_keys))
+        return states
+
+    def get_stored_states_with_ttl(self, keys: List[str]) -> Dict[str, Tuple[Any, Optional[float]]]:
+        """Прочитать состояния ключей из хранилища мимо памяти процесса и обновить ими память"""
+
+        states = {}
+        for key, (value, ttl) in zip(keys, self.storage.retrieve_values_with_ttl(keys)):
+            if value:
+                self.state.set(key, value, ttl)
+            states[key] = value, ttl
+        return states
+
+    def is_stale(self, ttl_left: Optional[float]) -> bool:
+        """Значение, записанное с ttl по умолчанию, прожило дольше soft_ttl"""
 
-        return self.storage.retrieve_value(key)
+        if not self.ttl or not self.soft_ttl or ttl_left is None:
+            return False
+        return ttl_left < (self.ttl - self.soft_ttl).total_seconds()
 
 
 use_case_state: State = None
@@ -1,4 +1,5 @@
 from datetime import timedelta
+from typing import Dict
 
 from pydantic import BaseSettings, Field
 
@@ -9,6 +10,22 @@ class Config(BaseSettings):
     backoff_max_time: int = Field(env='BACKOFF_MAX_TIME', default=1800000)
 
     etl_sleep_time: int = Field(env='ETL_SLEEP_TIME', default=60)
+    metrics_enabled: bool = Field(env='METRICS_ENABLED', default=True)
+    metrics_port: int = Field(env='METRICS_PORT', default=9108)
+    metrics_log_period: timedelta = Field(default=timedelta(minutes=5))
+    etl_max_sleep_time: int = Field(env='ETL_MAX_SLEEP_TIME', default=600)
+    etl_sleep_backoff_factor: float = Field(env='ETL_SLEEP_BACKOFF_FACTOR', default=2)
+    etl_sleep_jitter: float = Field(env='ETL_SLEEP_JITTER', default=0.1)
+    etl_pipeline_sleep_time: Dict[str, int] = Field(env='ETL_PIPELINE_SLEEP_TIME', default={})
+    etl_runtime: str = Field(env='ETL_RUNTIME', default='sync')
+    etl_queue_size: int = Field(env='ETL_QUEUE_SIZE', default=2)
+    etl_stage_concurrency: Dict[str, int] = Field(env='ETL_STAGE_CONCURRENCY', default={
+        'uc_is_check': 2,
+        'check_alert_existing': 2,
+        'get_uc_from_qradar': 2,
+        'get_is_from_qradar': 2,
+        'base_enrich_from_qradar': 2,
+    })
 
     priority_to_severity_map = Field(default={
         'Критический': 3,
@@ -22,11 +39,26 @@ class Config(BaseSettings):
     })
 
     redis_host: str = Field(env='REDIS_HOST', default='redis')
+    # json читают все версии ETL; msgpack включать, когда все контейнеры обновлены до версии с кодеками
+    redis_codec: str = Field(env='REDIS_CODEC', default='json')
+    redis_compress_threshold: int = Field(env='REDIS_COMPRESS_THRESHOLD', default=1024)
     redis_info_ttl: timedelta = Field(default=timedelta(hours=3))
+    redis_info_soft_ttl: timedelta = Field(default=timedelta(hours=2))
+    redis_negative_ttl: timedelta = Field(default=timedelta(minutes=15))
+    cache_refresh_workers: int = Field(env='CACHE_REFRESH_WORKERS', default=2)
+    redis_lock_key_prefix: str = Field(env='REDIS_LOCK_KEY_PREFIX', default='lock:')
+    redis_lock_ttl: timedelta = Field(default=timedelta(seconds=30))
+    cache_lock_wait: timedelta = Field(default=timedelta(seconds=10))
+    cache_lock_poll_interval: float = Field(env='CACHE_LOCK_POLL_INTERVAL', default=0.1)
+    state_max_local_entries: int = Field(env='STATE_MAX_LOCAL_ENTRIES', default=10000)
     redis_offense_type_key_prefix: str = Field(env='REDIS_DOMAIN_KEY_PREFIX', default='qradar_offense_type:')
     redis_domain_key_prefix: str = Field(env='REDIS_DOMAIN_KEY_PREFIX', default='qradar_domain:')
     redis_use_case_key_prefix: str = Field(env='REDIS_USE_CASE_KEY_PREFIX', default='UC:')
     redis_IS_key_prefix: str = Field(env='REDIS_IS_KEY_PREFIX', default='IS:')
+    redis_source_ref_index_key_prefix: str = Field(env='REDIS_SOURCE_REF_INDEX_KEY_PREFIX', default='sourceRef:')
+    redis_source_ref_index_window: timedelta = Field(default=timedelta(days=7))
+    redis_source_ref_index_warmup: timedelta = Field(default=timedelta(days=1))
+    redis_ninox_snapshot_key_prefix: str = Field(env='REDIS_NINOX_SNAPSHOT_KEY_PREFIX', default='ninox_snapshot:')
     redis_ELK_etl_key: str = Field(env='REDIS_ELK_ETL_KEY', default='ETL:elk')
     redis_qradar_etl_key: str = Field(env='REDIS_QRADAR_ETL_KEY', default='ETL:qradar')
     redis_sh_dm_qradar_etl_key: str = Field(env='REDIS_SH_DM_QRADAR_ETL_KEY', default='ETL:sh_dm_qradar')
@@ -37,21 +69,40 @@ class Config(BaseSettings):
     thehive_l2_apikey: str = Field(env='THEHIVE_L2_APIKEY')
     lpagetest_api_key: str = Field(env='THEHIVE_LPAGETEST_APIKEY')
     thehive_check_cert: bool = Field(env='THEHIVE_CHECK_CERT', default=False)
+    thehive_search_chunk_size: int = Field(env='THEHIVE_SEARCH_CHUNK_SIZE', default=100)
+    thehive_search_concurrency: int = Field(env='THEHIVE_SEARCH_CONCURRENCY', default=4)
+    thehive_create_concurrency: int = Field(env='THEHIVE_CREATE_CONCURRENCY', default=4)
 
     elk_url: str = Field(env='ELK_URL')
     elk_user: str = Field(env='ELK_USER')
     elk_pass: str = Field(env='ELK_PASS')
     elk_index: str = Field(env='ELK_INDEX', default='.alerts')
     elk_search_size: str = Field(env='ELK_SEARCH_SIZE', default=50)
+    elk_pit_keep_alive: str = Field(env='ELK_PIT_KEEP_ALIVE', default='5m')
+    # второе поле сортировки для search_after: уникальное keyword-поле с doc_values;
+    # _id требует fielddata (deprecated в 7.x, выключено в 8.x), смена поля сбрасывает порядок
+    # внутри одного timestamp для сохранённой позиции
+    elk_tiebreaker_field: str = Field(env='ELK_TIEBREAKER_FIELD', default='_id')
+    elk_source_fields: str = Field(
+        env='ELK_SOURCE_FIELDS',
+        default='timestamp,case.id,case.is.id,case.keyfield,case.description,case.information.source,index.name,'
+                'target.ports,source.ip,source.port,destination.ip,destination.port'
+    )
 
     portals_url: str = Field(env='P_URL')
     portals_obtain_token_url: str = Field(env='P_OBTAIN_TOKEN_URL')
     portals_refresh_token_url: str = Field(env='P_REFRESH_TOKEN_URL')
     portals_user: str = Field(env='P_USER')
     portals_pass: str = Field(env='P_PASS')
+    portals_pool_maxsize: int = Field(env='P_POOL_MAXSIZE', default=10)
+    portals_token_refresh_leeway: int = Field(env='P_TOKEN_REFRESH_LEEWAY', default=30)
+    portals_uc_id_field: str = Field(env='P_UC_ID_FIELD', default='id')
+    portals_uc_prefetch_enabled: bool = Field(env='P_UC_PREFETCH_ENABLED', default=True)
+    portals_uc_prefetch_period: timedelta = Field(default=timedelta(hours=1))
 
     dramatiq_max_backoff: int = Field(env='DEAMATIQ_MAX_BACKOFF', default=1800000)
     dramatiq_max_age: int = Field(env='DRAMATIQ_MAX_AGE', default=86400000)
+    dramatiq_alert_batch_size: int = Field(env='DRAMATIQ_ALERT_BATCH_SIZE', default=50)
 
     ninox_url: str = Field(env='NINOX_URL')
     ninox_username: str = Field(env='NINOX_USERNAME')
@@ -60,11 +111,25 @@ class Config(BaseSettings):
     ninox_database: str = Field(env='NINOX_DATABASE')
     ninox_IS_table: str = Field(env='NINOX_IS_TABLE')
     ninox_IS_UC_table: str = Field(env='NINOX_IS_UC_table')
+    # поле строки ИС с её id; снимок и точный поиск ИС включать после проверки поля по реальной таблице
+    ninox_IS_id_field: str = Field(env='NINOX_IS_ID_FIELD', default='ID')
+    ninox_IS_exact_lookup_enabled: bool = Field(env='NINOX_IS_EXACT_LOOKUP_ENABLED', default=False)
+    ninox_modified_field: str = Field(env='NINOX_MODIFIED_FIELD', default='_modifiedAt')
+    ninox_snapshot_enabled: bool = Field(env='NINOX_SNAPSHOT_ENABLED', default=False)
+    ninox_snapshot_refresh_period: timedelta = Field(default=timedelta(minutes=10))
+    ninox_snapshot_max_age: timedelta = Field(default=timedelta(hours=3))
 
     qradar_api_version: str = Field(env='QRADAR_API_VERSION', default='12.1')
     qradar_api_token: str = Field(env='QRADAR_API_TOKEN')
     qradar_server_ip: str = Field(env='QRADAR_SERVER_IP')
     qradar_verify_ssl: bool = Field(env='QRADAR_VERIFY_SSL')
+    qradar_pool_connections: int = Field(env='QRADAR_POOL_CONNECTIONS', default=1)
+    qradar_pool_maxsize: int = Field(env='QRADAR_POOL_MAXSIZE', default=10)
+    qradar_connect_timeout: float = Field(env='QRADAR_CONNECT_TIMEOUT', default=10)
+    qradar_read_timeout: float = Field(env='QRADAR_READ_TIMEOUT', default=120)
+    qradar_aql_min_check_period: float = Field(env='QRADAR_AQL_MIN_CHECK_PERIOD', default=1)
+    qradar_aql_max_check_period: float = Field(env='QRADAR_AQL_MAX_CHECK_PERIOD', default=60)
+    qradar_aql_max_concurrent_searches: int = Field(env='QRADAR_AQL_MAX_CONCURRENT_SEARCHES', default=5)
     qradar_irp_integration_closing_reason: str = Field(default='54')
     qradar_closed_offense_status: str = Field(default='CLOSED')
     qradar_search_sort: str = Field(env='QRADAR_SEARCH_SORT', default='+id')
@@ -117,6 +182,15 @@ class Config(BaseSettings):
                 'WHERE INOFFENSE({id}) LIMIT 1 '
                 'START {start_time} STOP {stop_time};'
     )
+    qradar_sh_dm_domain_aql_batch: bool = Field(env='QRADAR_SH_DM_DOMAIN_AQL_BATCH', default=True)
+    qradar_sh_dm_domain_batch_aql_query: str = Field(
+        env='QRADAR_SH_DM_DOMAIN_BATCH_AQL_QUERY',
+        default='SELECT {offense_id} as offense_id, "SH-DM-003-Domain" as domain_name '
+                'FROM events '
+                'WHERE {in_offenses} '
+                'GROUP BY offense_id '
+                'START {start_time} STOP {stop_time};'
+    )
     qradar_sh_vcm_001_aql_query: str = Field(
         env='QRADAR_SH_VCM_001_AQL_QUERY',
         default='SELECT "dev_address","group_name","log_source_name", QIDNAME(qid) '